@@ -147,6 +147,8 @@ if __name__ == '__main__':
     sc_file = os.path.join(THIS_SCRIPT_LOCATION, 'traffic_light_state.svg')
     sc1 = scsvg.StateChart(sc_file)
     sc1.refresh(True)
+    # Pick up changes whenever the diagram is exported again from UMLet.
+    sc1.watch()
     sc1_context = TrafficLight_SC()
     sc1.configure(sc1_context, [])
 
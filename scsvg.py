@@ -26,16 +26,33 @@
 Simulate a State Chart drawn in SVG format (presently works with
 an SVG exported from UmLet application)
 """
-import sys
+import os
+import copy
 import itertools
+import threading
 import collections
 import random
 import re
 import math
+import time
+import heapq
+import hashlib
 from functools import cmp_to_key
 
-from PySide2.QtSvg import QSvgWidget
-from PySide2.QtCore import QByteArray
+try:
+    from PySide2.QtSvg import QSvgWidget
+    from PySide2.QtCore import Qt, QByteArray, QFileSystemWatcher, QTimer, Signal
+    from PySide2.QtCore import QPointF, QRectF
+    from PySide2.QtGui import QColor, QImage, QPainter, QPen, QPolygonF
+except ImportError:
+    # The diagram parser works without Qt (e.g. for batch linting), only the
+    # StateChart widget needs it.
+    class QSvgWidget():
+        pass
+    Qt = QByteArray = QFileSystemWatcher = QTimer = None
+    QPointF = QRectF = QColor = QImage = QPainter = QPen = QPolygonF = None
+    def Signal(*types):
+        return None
 
 import pysvg.core
 import pysvg.shape
@@ -43,6 +60,11 @@ import pysvg.text
 import pysvg.parser
 
 
+class StateChartError(Exception):
+    """Raised when the diagram can not be turned into a state chart."""
+    pass
+
+
 #------------------------------------------------------------------------------
 #------------------------------------------------------------------------------
 class DiagramPoint:
@@ -87,18 +109,26 @@ class DiagramCircle:
         """ Check if the given point is attached to this circle."""
         return self.is_on_perimeter(p) or self.encloses(p)
 
+    def bounds(self):
+        """ Return the bounding box (x1, y1, x2, y2) of this circle."""
+        return (self.center.x - self.radius, self.center.y - self.radius,
+                self.center.x + self.radius, self.center.y + self.radius)
+
 
 #------------------------------------------------------------------------------
 #------------------------------------------------------------------------------
 class DiagramBox:
-    def __init__(self, x, y, w, h, rotation_angle = 0):
+    def __init__(self, x, y, w, h, rotation_angle = 0, rx = 0, ry = 0):
         """Given upper left corner cooridinate point,width & height,
-        initialize the perimeter points of the box."""
+        initialize the perimeter points of the box. rx and ry are the radii
+        of rounded corners (only used for drawing)."""
         self.p_ul = DiagramPoint(x, y)
         self.p_ur = DiagramPoint(x+w, y)
         self.p_bl = DiagramPoint(x, y+h)
         self.p_br = DiagramPoint(x+w, y+h)
         self.rotation_angle = rotation_angle
+        self.rx = rx
+        self.ry = ry
 
     def _get_rotated(self, p):
         x = p.x - self.p_ul.x
@@ -158,6 +188,31 @@ class DiagramBox:
         """ Check if the given point is attached to this box."""
         return self.is_on_perimeter(p)
 
+    def corners(self):
+        """ Return the corner points of this box, rotation included."""
+        c = math.cos(-self.rotation_angle)
+        s = math.sin(-self.rotation_angle)
+        w = self.p_br.x - self.p_ul.x
+        h = self.p_br.y - self.p_ul.y
+        return [DiagramPoint(self.p_ul.x + x*c - y*s, self.p_ul.y + x*s + y*c)
+                for x, y in ((0, 0), (w, 0), (w, h), (0, h))]
+
+    def bounds(self):
+        """ Return a bounding box (x1, y1, x2, y2) of this box. A rotated box
+        can be anywhere within its diagonal of the upper left corner."""
+        if self.rotation_angle:
+            d = math.hypot(self.p_br.x - self.p_ul.x, self.p_br.y - self.p_ul.y)
+            return (self.p_ul.x - d, self.p_ul.y - d, self.p_ul.x + d, self.p_ul.y + d)
+        return (self.p_ul.x, self.p_ul.y, self.p_br.x, self.p_br.y)
+
+    def overlaps(self, b):
+        """ Check if the given box partially overlaps this box i.e. they share
+        some area but neither of them encloses the other."""
+        if ((b.p_ul.x >= self.p_br.x) or (self.p_ul.x >= b.p_br.x) or
+            (b.p_ul.y >= self.p_br.y) or (self.p_ul.y >= b.p_br.y)):
+            return False
+        return not (self.encloses(b) or b.encloses(self))
+
 
 def pysvg_getSubElements(element):
     sub_elements = []
@@ -185,12 +240,24 @@ class State():
         #print(self.name)
         self.svg_shape = svg_shape
         self.svg_shape_transform = svg_shape_transform
+        self.svg_key = None
         self.sub_states = []
         self.parent_states = []
         self.init_states = []
         self.out_transitions = []
+        self.in_transitions = []
         self.all_out_transitions = []
         self.level = 0
+        # Position in the depth first ordering of the chart, the descendants of
+        # this state are the ones positioned in [order+1, order_end).
+        self.order = 0
+        self.order_end = 0
+        # Bit masks over the states of the chart (see build_transition_tables)
+        self.bit = 0
+        self.ancestors_mask = 0
+        self.transition_regions = {}
+        # What entering this state leads to (see build_entry_closures)
+        self.default_entry = None
 
         if(isinstance(self.svg_shape, pysvg.shape.Rect)):
             # Given upper left corner coordinate point,width & height,
@@ -205,7 +272,8 @@ class State():
                 x += tx
                 y += ty
             print("[State: %s] x,y,h,w: %s,%s,%s,%s" % (self.name, x,y,h,w))
-            self.shape = DiagramBox(x,y,w,h)
+            self.shape = DiagramBox(x,y,w,h, 0, float(self.svg_shape.get_rx() or 0),
+                                    float(self.svg_shape.get_ry() or 0))
         elif(isinstance(self.svg_shape, pysvg.shape.Polygon)):
             points = self.svg_shape.get_points()
             points = [float(p.strip()) for p in points.strip().split(" ")]
@@ -224,8 +292,7 @@ class State():
                 print("[State: %s] x,y,h,w,rotation: %s,%s,%s,%s,%s" % (self.name, x,y,h,w,-rotation_angle))
                 self.shape = DiagramBox(x,y,w,h,-rotation_angle)
             else:
-                print("Found an known polygon shape: %s" % points)
-                sys.exit(1)
+                raise StateChartError("[State: %s] Found an unknown polygon shape: %s" % (self.name, points))
 
         elif(isinstance(self.svg_shape, pysvg.shape.Circle)):
             cx = float(self.svg_shape.get_cx())
@@ -239,8 +306,7 @@ class State():
             print("[State: %s] x,y,r: %s,%s,%s" % (self.name, cx,cy,r))
             self.shape = DiagramCircle(cx,cy,r)
         else:
-            print("Unknown shape!")
-            sys.exit(1)
+            raise StateChartError("[State: %s] Unknown shape!" % self.name)
 
 
     def levelize(self, level=None):
@@ -260,6 +326,8 @@ class State():
     def select_sub_states(self, states):
         """Given a list of states, update this state's sub-states.
         """
+        self.sub_states = []
+        self.init_states = []
         # 1. Find all the states this state encloses
         sub_states1 = []
         for s in states:
@@ -294,7 +362,7 @@ class State():
                 continue
             if s.shape.encloses(self.shape):
                 parent_states1.append(s)
-        # Sort the list in such a way immediate parent, grand parent, great grand parent, etc..
+        # Sort the list outer most first: great grand parent, grand parent, immediate parent.
         parent_states2 = sorted(parent_states1, key =cmp_to_key(lambda s1, s2: -1 if (s1.shape.encloses(s2.shape)) else 1))
         self.parent_states = parent_states2
 
@@ -305,14 +373,20 @@ class State():
         """ Assuming that this state knows its parents and its own transitions,
         build a list of all transitions that can make this state exist.
         """
+        self.all_out_transitions = []
         # Collect all applicable out transitions on order of priority
         # highest priority is the outer most state
-        for ps in reversed(self.parent_states):
+        for ps in self.parent_states:
             for t in ps.out_transitions:
                 self.all_out_transitions.append(t)
         for t in self.out_transitions:
             self.all_out_transitions.append(t)
 
+    def full_name(self):
+        """ The dotted name of this state starting from the outer most parent
+        e.g. 's1.s12.s121'."""
+        return ".".join([ps.name for ps in self.parent_states] + [self.name])
+
     def __repr__(self):
         #fmt1 = "State: %s sub-states %s parent-states %s"
         #result =  fmt1 % (self.name,
@@ -363,23 +437,62 @@ def find_state(element, transform=[]):
         return (None, None, found_potential_substates)
 
 
-def find_all_states(element, list_of_states=[], transform=[]):
+def svg_group_key(svg_group, transform):
+    """ Identify a diagram element by the content and placement of its SVG
+    group, so unchanged elements can be recognized when the diagram is
+    re-exported."""
+    return (tuple(transform), hashlib.sha1(svg_group.getXML().encode("utf-8")).digest())
+
+
+def _append_element(list_of_elements, new_element, svg_shape, svg_group, transform,
+                    errors=None, known=None):
+    """ Create a state or transition by calling new_element() and add it to
+    the list. If an errors list is given, problems are collected into it
+    instead of being raised. If a known dictionary (see svg_group_key) is
+    given, an element whose group did not change is taken from it instead of
+    being extracted again."""
+    key = None
+    if known is not None:
+        key = svg_group_key(svg_group, transform)
+        e = known.pop(key, None)
+        if e is not None:
+            e.svg_shape = svg_shape
+            list_of_elements.append(e)
+            return
+    try:
+        e = new_element()
+    except StateChartError as ex:
+        if errors is None:
+            raise
+        errors.append(str(ex))
+        return
+    e.svg_key = key
+    list_of_elements.append(e)
+
+
+def find_all_states(element, list_of_states=None, transform=None, errors=None, known=None):
+    if list_of_states is None:
+        list_of_states = []
+    if transform is None:
+        transform = []
     if isinstance(element, pysvg.structure.G):
         (name, shape, potential_substates) = find_state(element, transform)
         if name and shape:
             (shape, parent_G, t2) = shape
-            list_of_states.append(State(name, shape, t2))
+            _append_element(list_of_states, lambda: State(name, shape, t2),
+                            shape, parent_G, t2, errors, known)
         for e2,t2 in potential_substates:
-            list_of_states = find_all_states(e2, list_of_states, transform+t2)
+            list_of_states = find_all_states(e2, list_of_states, transform+t2, errors, known)
     else:
         for e1 in pysvg_getSubElements(element):
             if isinstance(e1, pysvg.structure.G):
                 (name, shape, potential_substates) = find_state(e1, transform)
                 if name and shape:
                     (shape, parent_G, t2) = shape
-                    list_of_states.append(State(name, shape, t2))
+                    _append_element(list_of_states, lambda: State(name, shape, t2),
+                                    shape, parent_G, t2, errors, known)
                 for e2,t2 in potential_substates:
-                    list_of_states = find_all_states(e2, list_of_states, transform+t2)
+                    list_of_states = find_all_states(e2, list_of_states, transform+t2, errors, known)
     return list_of_states
 
 
@@ -418,13 +531,144 @@ def transition_get_endpoints(shape):
     return(x1,y1,x2,y2)
     
 
+PATH_POINT_PAT = re.compile(r"([ML])\s*(-?[0-9.eE+-]+)[\s,]+(-?[0-9.eE+-]+)")
+
+
+def transition_get_segments(shape):
+    """ Given shape of the transition, return all its line segments
+    (x1, y1, x2, y2) including the arrow head, see transition_get_endpoints."""
+    segments = []
+    for e in shape:
+        if isinstance(e, pysvg.shape.Line):
+            segments.append((float(e.get_x1()), float(e.get_y1()),
+                             float(e.get_x2()), float(e.get_y2())))
+            continue
+        p = None
+        for cmd, x, y in PATH_POINT_PAT.findall(e.get_d() or ""):
+            if (cmd == "L") and p:
+                segments.append(p + (float(x), float(y)))
+            p = (float(x), float(y))
+    return segments
+
+
+def segment_distance(segment, x, y):
+    """ Return the distance of the point (x, y) from the line segment."""
+    x1, y1, x2, y2 = segment
+    dx = x2 - x1
+    dy = y2 - y1
+    d = dx*dx + dy*dy
+    u = 0.0
+    if d:
+        u = min(1.0, max(0.0, ((x - x1)*dx + (y - y1)*dy) / d))
+    return math.hypot(x1 + u*dx - x, y1 + u*dy - y)
+
+
+class SpatialIndex():
+    """ A static R-tree of bounding boxes, bulk loaded by sort-tile-recursive
+    packing. Finding the items whose box contains a point only descends into
+    the nodes containing it, logarithmic in the number of items.
+    """
+    NODE_SIZE = 8
+
+    def __init__(self, items):
+        """ Given a list of ((x1, y1, x2, y2), item), build the tree."""
+        self.root = None
+        entries = list(items)
+        is_leaf = True
+        while entries:
+            nodes = [(self._union(group), group, is_leaf) for group in self._pack(entries)]
+            if len(nodes) == 1:
+                self.root = nodes[0]
+                break
+            entries = nodes
+            is_leaf = False
+
+    def _union(self, entries):
+        return (min(e[0][0] for e in entries), min(e[0][1] for e in entries),
+                max(e[0][2] for e in entries), max(e[0][3] for e in entries))
+
+    def _pack(self, entries):
+        n = self.NODE_SIZE
+        n_slices = int(math.ceil(math.sqrt(math.ceil(len(entries) / float(n)))))
+        slice_size = n_slices*n
+        entries = sorted(entries, key=lambda e: e[0][0] + e[0][2])
+        groups = []
+        for i in range(0, len(entries), slice_size):
+            vertical_slice = sorted(entries[i:i+slice_size], key=lambda e: e[0][1] + e[0][3])
+            for j in range(0, len(vertical_slice), n):
+                groups.append(vertical_slice[j:j+n])
+        return groups
+
+    def query(self, x, y):
+        """ Return the items whose bounding box contains the point."""
+        found = []
+        stack = [self.root] if self.root else []
+        while stack:
+            box, entries, is_leaf = stack.pop()
+            for e in entries:
+                b = e[0]
+                if (b[0] <= x <= b[2]) and (b[1] <= y <= b[3]):
+                    if is_leaf:
+                        found.append(e[1])
+                    else:
+                        stack.append(e)
+        return found
+
+
+TIMEOUT_PAT = re.compile(r"""^\s*after(?:\s*\(\s*(?P<n1>[0-9.]+)\s*(?P<u1>ms|s|sec|min)?\s*\)
+                               |_(?P<n2>[0-9.]+)_?(?P<u2>ms|s|sec|min))\s*$""", re.VERBOSE)
+TIMEOUT_UNITS = {None: 1.0, "s": 1.0, "sec": 1.0, "ms": 0.001, "min": 60.0}
+
+
+def parse_timeout(trigger):
+    """ Given a trigger text like 'after(20)', 'after(500 ms)' or
+    'after_20_sec', return the timeout in seconds, otherwise None."""
+    m = TIMEOUT_PAT.match(trigger)
+    if not m:
+        return None
+    if m.group("n1") is not None:
+        n, unit = m.group("n1"), m.group("u1")
+    else:
+        n, unit = m.group("n2"), m.group("u2")
+    try:
+        return float(n)*TIMEOUT_UNITS[unit]
+    except ValueError:
+        return None
+
+
+# A guard needs a blank (or nothing) before its '[' and the action separator
+# blanks around its '/', so 'x[0]' and 'count/2' stay part of the trigger.
+TRANSITION_LABEL_PAT = re.compile(r"^(?P<trigger>.*?)(?:(?:^|(?<=\s))\[(?P<guard>[^\[\]]*)\])?\s*"
+                                  r"(?:(?:^|(?<=\s))/\s+(?P<action>.*))?$", re.DOTALL)
+
+
+def parse_transition_label(text):
+    """ Given the text of a transition, return its (trigger, guard, action)
+    from the UML form 'trigger [guard] / action', every part is optional.
+    Without a guard, a text which is a Python expression as a whole (e.g.
+    'speed / 2 >= limit') is taken as the trigger."""
+    m = TRANSITION_LABEL_PAT.match(text)
+    if not m:
+        return (text.strip(), "", "")
+    if (m.group("guard") is None) and (m.group("action") is not None):
+        try:
+            compile(text.strip().replace("\n", " "), "<transition>", "eval")
+            return (text.strip(), "", "")
+        except SyntaxError:
+            pass
+    return (m.group("trigger").strip(), (m.group("guard") or "").strip(),
+            (m.group("action") or "").strip())
+
+
 class Transition():
     def __init__(self, svg_shape, text, svg_shape_transform=[]):
         self.text = text
         self.svg_shape = svg_shape
         self.svg_shape_transform = svg_shape_transform
+        self.svg_key = None
 
         (x1, y1, x2, y2) = transition_get_endpoints(self.svg_shape)
+        self.segments = transition_get_segments(self.svg_shape)
 
         for t in self.svg_shape_transform:
             tx,ty = eval(t)
@@ -433,15 +677,16 @@ class Transition():
             y1 += ty
             x2 += tx
             y2 += ty
+            self.segments = [(sx1+tx, sy1+ty, sx2+tx, sy2+ty)
+                             for sx1, sy1, sx2, sy2 in self.segments]
         print("[%s]:x1,y1,x2,y2: %s,%s,%s,%s" % (self.text,x1,y1,x2,y2))
         self.pt1 = DiagramPoint(x1, y1)
         self.pt2 = DiagramPoint(x2, y2)
         self.pt1_state = None
         self.pt2_state = None
-        # TODO: Parse self.text into trigger, guard, action
-        self.trigger = self.text.strip()
-        self.guard = ""
-        self.action = ""
+        self.trigger, self.guard, self.action = parse_transition_label(self.text)
+        # Seconds after entering pt1_state this transition triggers on its own.
+        self.timeout = parse_timeout(self.trigger)
 
     def select_end_states(self, states):
         """Given a list of states, update this transition's end point states.
@@ -455,17 +700,18 @@ class Transition():
                 pt2_state = s
             if pt1_state and pt2_state:
                 break
-        if pt1_state:
-            self.pt1_state = pt1_state
-        else:
-            print("Error transition [%s] dangling at pt1." % self.text)
-            sys.exit(1)
-
-        if pt2_state:
-            self.pt2_state = pt2_state
-        else:
-            print("Error: transition [%s] dangling at pt2." % self.text)
-            sys.exit(1)
+        self.pt1_state = pt1_state
+        self.pt2_state = pt2_state
+        dangling = [pt for pt, s in (("pt1", pt1_state), ("pt2", pt2_state)) if not s]
+        if dangling:
+            raise StateChartError("Error: transition [%s] dangling at %s." %
+                                  (self.text, " and ".join(dangling)))
+
+    def bounds(self):
+        """ Return the bounding box (x1, y1, x2, y2) of the segments."""
+        xs = [x for sg in self.segments for x in (sg[0], sg[2])]
+        ys = [y for sg in self.segments for y in (sg[1], sg[3])]
+        return (min(xs), min(ys), max(xs), max(ys))
 
     def __repr__(self):
         fmt1 = "Transition: %s -> %s"
@@ -504,22 +750,27 @@ def find_transition(element, transform=[]):
         return ([], None, element, transform, found_potential_transitions)
 
 
-def find_all_transitions(element, list_of_transitions=[], transform=[]):
+def find_all_transitions(element, list_of_transitions=None, transform=None, errors=None, known=None):
+    if list_of_transitions is None:
+        list_of_transitions = []
+    if transform is None:
+        transform = []
     if isinstance(element, pysvg.structure.G):
         (shape, guard, parent_G, t2, potential_transitions) = find_transition(element, transform)
         if shape:
-            list_of_transitions.append(Transition(shape, guard, t2))
+            _append_element(list_of_transitions, lambda: Transition(shape, guard, t2),
+                            shape, parent_G, t2, errors, known)
         for e2,t2 in potential_transitions:
-            list_of_transitions = find_all_transitions(e2, list_of_transitions, transform+t2)
+            list_of_transitions = find_all_transitions(e2, list_of_transitions, transform+t2, errors, known)
     else:
         for e1 in pysvg_getSubElements(element):
             if isinstance(e1, pysvg.structure.G):
                 (shape, guard, parent_G, t2, potential_transitions) = find_transition(e1, transform)
                 if shape:
-                    #TODO: What should the name be?
-                    list_of_transitions.append(State("?name?", shape, t2))
+                    _append_element(list_of_transitions, lambda: Transition(shape, guard, t2),
+                                    shape, parent_G, t2, errors, known)
                 for e2,t2 in potential_transitions:
-                    list_of_transitions = find_all_transitions(e2, list_of_transitions, transform+t2)
+                    list_of_transitions = find_all_transitions(e2, list_of_transitions, transform+t2, errors, known)
     return list_of_transitions
 
 
@@ -533,6 +784,78 @@ def pysvg_main2(col="red"):
     return anSVG.getXML()
 
 
+class VirtualClock():
+    """ Simulated time, it only moves when told to. StateChart.advance_time
+    jumps it straight to the next timer deadline."""
+    def __init__(self, t=0.0):
+        self.t = t
+
+    def now(self):
+        return self.t
+
+    def set_time(self, t):
+        self.t = t
+
+
+class RealClock():
+    """ Wall clock time in seconds since the clock was created."""
+    def __init__(self):
+        self.t_start = time.monotonic()
+
+    def now(self):
+        return time.monotonic() - self.t_start
+
+
+class SvgTemplate():
+    """ The serialized SVG document of a state chart, split around the stroke
+    color of every state and transition shape. A highlighted frame is then
+    rendered by joining strings instead of updating and serializing the pysvg
+    tree. Every shape also gets an id 'scsvg-<n>' so it can be referred to
+    (e.g. by SMIL animations), see element_ids.
+    """
+    SLOT_PAT = re.compile(r"@SCSVG(\d+)@")
+
+    def __init__(self, states, transitions, get_xml):
+        """ Given the states and transitions of the chart and a function
+        returning the serialized document, build the template."""
+        self.elements = list(states) + list(transitions)
+        self.element_numbers = dict((e, n) for n, e in enumerate(self.elements))
+        shapes = [(s.svg_shape, n) for n, s in enumerate(states)]
+        for n, t in enumerate(transitions, len(states)):
+            shapes += [(line, n) for line in t.svg_shape]
+
+        self.element_ids = [[] for e in self.elements]
+        saved = [(e, e.getAttribute("id"), e.getAttribute("stroke")) for e, n in shapes]
+        try:
+            for slot, (e, n) in enumerate(shapes):
+                e.setAttribute("id", "scsvg-%d" % slot)
+                e.setAttribute("stroke", "@SCSVG%d@" % slot)
+                self.element_ids[n].append("scsvg-%d" % slot)
+            xml = get_xml()
+        finally:
+            for e, svg_id, stroke in saved:
+                e.setAttribute("id", svg_id)
+                e.setAttribute("stroke", stroke)
+
+        parts = self.SLOT_PAT.split(xml)
+        self.chunks = parts[0::2]
+        self.slot_elements = [shapes[int(slot)][1] for slot in parts[1::2]]
+
+    def iter_render(self, elements, color="red", default_color="black"):
+        """ Yield the pieces of the document with the given states and
+        transitions highlighted."""
+        lit = set(self.element_numbers[e] for e in elements if e in self.element_numbers)
+        yield self.chunks[0]
+        for n, chunk in zip(self.slot_elements, self.chunks[1:]):
+            yield color if n in lit else default_color
+            yield chunk
+
+    def render(self, elements, color="red", default_color="black"):
+        """ Return the document with the given states and transitions
+        highlighted."""
+        return "".join(self.iter_render(elements, color, default_color))
+
+
 class StateChartContextDefault():
     def __init__(self):
         pass
@@ -541,37 +864,68 @@ class StateChartContextDefault():
         return random.choice([True, False])
 
 
-class StateChart(QSvgWidget):
-    def __init__(self, svg_filename="", parent=None):
-        QSvgWidget.__init__(self, parent=None)
+class StateChartModel():
+    """ The states and transitions of a state chart diagram, how they are
+    connected and the tables precomputed from that. It holds no simulation
+    state and needs no Qt, so one model can be shared by any number of
+    StateChartInstance objects. Once loaded the instances only read it. A
+    shared model (see load_model) refuses to reload() or release_svg().
+    """
+    # How far from a transition (in diagram units) a click still hits it.
+    HIT_TOLERANCE = 4.0
+    INDEX_PIECE_LENGTH = 50.0
+    INDEX_PIECES = 8
+
+    def __init__(self, svg_filename=""):
         self.svg_filename = svg_filename
         self.svg = pysvg.parser.parse(self.svg_filename)
-        self.all_states = find_all_states(self.svg)
-        self.all_transitions = find_all_transitions(self.svg)
+        self.all_states = find_all_states(self.svg, [], [], None, {})
+        self.all_transitions = find_all_transitions(self.svg, [], [], None, {})
         self.top_states = []
         self.top_init_states = []
-        self.current_states = []
-        self.highlighted_states = []
-        self.highlighted_transitions = []
-        self.context_object = StateChartContextDefault()
+        self.ordered_states = []
+        self.states_by_full_name = {}
+        self.states_by_name = {}
+        self.svg_template = None
+        self.lean = False
+        self.lean_keep_template = False
+        self.shape_index = None
+        # Set once others may run on the model, it must not change any more.
+        self.shared = False
 
         # Teach the Transition and State objects how they are connected
         # to each other.
         for t in self.all_transitions:
             t.select_end_states(self.all_states)
-            t.pt1_state.add_out_transitions(t)
             print(t)
 
         for s in self.all_states:
             s.select_sub_states(self.all_states)
             s.select_parent_states(self.all_states)
+            print(s)
+
+        self.link_states()
+
+    def link_states(self):
+        """ Once every state knows its parents and sub-states and every
+        transition knows its end states, find the top states, the nesting levels,
+        the in/out transitions of each state and index the states by name.
+        """
+        self.top_states = []
+        self.top_init_states = []
+        for s in self.all_states:
+            s.out_transitions = []
+            s.in_transitions = []
             # If the state does not have a parent state then, it is a top state
             # in the diagram
             if not s.parent_states:
                 self.top_states.append(s)
                 if s.name == State.INIT_NAME:
                     self.top_init_states.append(s)
-            print(s)
+
+        for t in self.all_transitions:
+            t.pt1_state.add_out_transitions(t)
+            t.pt2_state.in_transitions.append(t)
 
         # Teach the states their nesting level.
         for s in self.top_states:
@@ -581,35 +935,259 @@ class StateChart(QSvgWidget):
         for s in self.all_states:
             s.find_all_out_transitions()
 
-        # Enter the state chart through the initial states
-        self.current_states = self.top_init_states
-
-        self.highlight_states(self.current_states)
-        self.highlight_transitions(self.highlighted_transitions)
-
+        self.index_states()
+        self.build_transition_tables()
+        self.build_entry_closures()
+        self.index_shapes()
 
-    def configure(self, context_object=None, initial_states=None):
-        """ Given the context object and initial states, the state chart is
-        configured.
+    def index_states(self):
+        """ Number the states in depth first order (so the descendants of a
+        state are a contiguous range) and index them by their fully qualified
+        and short names.
         """
-        if context_object != None:
-            self.context_object = context_object
-
-        if initial_states != None:
-            current_states = []
-            for si in initial_states:
-                for s in self.all_states:
-                    s_fqun = [ps.name for ps in s.parent_states]
-                    s_fqun.append(s.name)
-                    s_fqun = ".".join(s_fqun)
-                    if(si.strip() == s_fqun):
-                        current_states.append(s)
-            if current_states:
-                self.current_states = current_states
-                self.highlight_states(self.current_states)
-                self.highlight_transitions([])
-                self.refresh()
+        self.ordered_states = []
+        stack = list(reversed(self.top_states))
+        while stack:
+            s = stack.pop()
+            s.order = len(self.ordered_states)
+            self.ordered_states.append(s)
+            stack.extend(reversed(s.sub_states))
+        # States with inconsistent nesting (e.g. identical boxes) can not be
+        # reached from the top states, number them anyway.
+        if len(self.ordered_states) != len(self.all_states):
+            ordered = set(self.ordered_states)
+            for s in self.all_states:
+                if s not in ordered:
+                    s.order = len(self.ordered_states)
+                    self.ordered_states.append(s)
+        # Sub-states are numbered after their parent, so close the ranges
+        # starting from the last numbered state.
+        for s in reversed(self.ordered_states):
+            s.order_end = max([s.order + 1] + [ss.order_end for ss in s.sub_states])
+
+        self.states_by_full_name = collections.defaultdict(list)
+        self.states_by_name = collections.defaultdict(list)
+        for s in self.ordered_states:
+            self.states_by_full_name[s.full_name()].append(s)
+            self.states_by_name[s.name].append(s)
+        self.states_by_full_name = dict(self.states_by_full_name)
+        self.states_by_name = dict(self.states_by_name)
+
+    def build_transition_tables(self):
+        """ Precompute what is needed to resolve conflicting transitions, which
+        only depends on the hierarchy: every state gets a bit and a mask of its
+        ancestors, and every (state, transition) pair the state can take gets
+        the mask of the states its path exits and enters. A transition taken
+        from one state then affects another state if the region mask and the
+        other state's ancestors mask intersect.
+        """
+        for n, s in enumerate(self.ordered_states):
+            s.bit = 1 << n
+        for s in self.ordered_states:
+            s.ancestors_mask = 0
+            for ps in s.parent_states:
+                s.ancestors_mask |= ps.bit
+        for s in self.ordered_states:
+            s.transition_regions = {}
+            for t in s.all_out_transitions:
+                s.transition_regions[t] = self.get_transition_region(s, t)
+
+    def build_entry_closures(self):
+        """ Precompute the default entry of every state. Entering a state that
+        contains init states follows their transitions, level by level, down
+        to the states that do not. Only branch pseudo-states need the context,
+        so the walk stops before the first level holding a branch and
+        take_step resumes it from there. Each state gets a tuple of the
+        transitions and states highlighted on the way, the states reached and
+        whether those are final (the new current states) or still to resume.
+        """
+        max_levels = len(self.all_states) + 1
+        for s in self.all_states:
+            transitions = []
+            states = []
+            cs1 = [s]
+            done = False
+            for level in range(max_levels):
+                if [x for x in cs1 if x.name == State.BRANCH_NAME]:
+                    break
+                no_init_state = True
+                cs2 = cs1
+                cs1 = []
+                for x in cs2:
+                    if not x.init_states:
+                        cs1.append(x)
+                        continue
+                    for init_state in x.init_states:
+                        no_init_state = False
+                        states.append(init_state)
+                        for t in init_state.out_transitions:
+                            transitions.append(t)
+                            states.append(t.pt2_state)
+                            cs1.append(t.pt2_state)
+                if no_init_state:
+                    cs1 = cs2
+                    done = True
+                    break
+            s.default_entry = (transitions, states, cs1, done)
+
+    def get_transition_region(self, state, transition):
+        """ Return the mask of the states exited and entered when the state
+        leaves through the transition."""
+        region = state.transition_regions.get(transition)
+        if region is None:
+            region = 0
+            for p in self.get_path(state, transition.pt2_state):
+                region |= p[2].bit
+        return region
+
+    def index_shapes(self):
+        """ Build the spatial index used by element_at: the bounding box of
+        every state and of every transition segment (widened by
+        HIT_TOLERANCE)."""
+        d = self.HIT_TOLERANCE
+        items = [(s.shape.bounds(), s) for s in self.all_states]
+        # Long (diagonal) segments are indexed in pieces, so their boxes do
+        # not cover most of the diagram. There are at most about
+        # INDEX_PIECES pieces per segment on average.
+        segments = [sg for t in self.all_transitions for sg in t.segments]
+        total_length = sum(math.hypot(x2 - x1, y2 - y1) for x1, y1, x2, y2 in segments)
+        piece_length = max(self.INDEX_PIECE_LENGTH,
+                           total_length / (self.INDEX_PIECES*max(1, len(segments))))
+        for t in self.all_transitions:
+            for x1, y1, x2, y2 in t.segments:
+                n = max(1, int(math.ceil(math.hypot(x2 - x1, y2 - y1) / piece_length)))
+                for k in range(n):
+                    px1 = x1 + (x2 - x1)*k/n
+                    py1 = y1 + (y2 - y1)*k/n
+                    px2 = x1 + (x2 - x1)*(k + 1)/n
+                    py2 = y1 + (y2 - y1)*(k + 1)/n
+                    items.append(((min(px1, px2) - d, min(py1, py2) - d,
+                                   max(px1, px2) + d, max(py1, py2) + d),
+                                  (t, (px1, py1, px2, py2))))
+        self.shape_index = SpatialIndex(items)
+
+    def element_at(self, x, y):
+        """ Return the element of the diagram at the point (in diagram
+        coordinates): the nearest transition within HIT_TOLERANCE of it or
+        else the inner most state enclosing it. Return None if there is
+        neither."""
+        p = DiagramPoint(x, y)
+        transition = None
+        state = None
+        distance = self.HIT_TOLERANCE
+        for e in self.shape_index.query(x, y):
+            if isinstance(e, State):
+                if e.shape.encloses(p) and ((state is None) or (e.level > state.level)):
+                    state = e
+            else:
+                d = segment_distance(e[1], x, y)
+                if d <= distance:
+                    transition, distance = e[0], d
+        return transition or state
+
+    def get_states(self, name):
+        """ Return the list of states with the given fully qualified name
+        (e.g. 's1.s12') or, if there is none, with the given short name.
+        """
+        name = name.strip()
+        return self.states_by_full_name.get(name) or self.states_by_name.get(name, [])
 
+    def get_state(self, name):
+        """ Return the one state with the given fully qualified or short name.
+        StateChartError is raised if there is no such state or the name is
+        ambiguous.
+        """
+        if isinstance(name, State):
+            return name
+        states = self.get_states(name)
+        if not states:
+            raise StateChartError("No state named [%s]." % name)
+        if len(states) > 1:
+            raise StateChartError("State name [%s] is ambiguous: %s" %
+                                  (name, [s.full_name() for s in states]))
+        return states[0]
+
+    def get_ancestors(self, state):
+        """ Return the ancestors of the state, outer most first."""
+        return list(self.get_state(state).parent_states)
+
+    def get_descendants(self, state):
+        """ Return all the states nested inside the state in depth first order."""
+        s = self.get_state(state)
+        return self.ordered_states[s.order+1:s.order_end]
+
+    def is_descendant(self, state, ancestor):
+        """ Check if the state is nested (at any depth) inside the ancestor."""
+        s = self.get_state(state)
+        a = self.get_state(ancestor)
+        return a.order < s.order < a.order_end
+
+    def get_out_transitions(self, state):
+        """ Return the transitions leaving the state itself."""
+        return list(self.get_state(state).out_transitions)
+
+    def get_in_transitions(self, state):
+        """ Return the transitions entering the state itself."""
+        return list(self.get_state(state).in_transitions)
+
+    def reload(self):
+        """ Re-read the SVG file after it has been edited and exported again.
+        Only the SVG groups that changed are extracted again and only the states
+        and transitions they touch get their hierarchy and end states updated.
+        If the new diagram is broken the exception is raised and the model is
+        left as it was.
+        """
+        self.check_not_shared()
+        svg = pysvg.parser.parse(self.svg_filename)
+        old_states = self.all_states
+        old_transitions = self.all_transitions
+        # Unchanged elements are re-attached to the new document as they are
+        # found, remember how to undo that in case the new diagram is broken.
+        old_shapes = [(e, e.svg_shape) for e in old_states]
+        old_shapes += [(t, t.svg_shape, t.pt1_state, t.pt2_state) for t in old_transitions]
+        try:
+            all_states = find_all_states(svg, [], [], None,
+                                         dict((s.svg_key, s) for s in old_states))
+            all_transitions = find_all_transitions(svg, [], [], None,
+                                                   dict((t.svg_key, t) for t in old_transitions))
+            added_states = set(all_states) - set(old_states)
+            removed_states = set(old_states) - set(all_states)
+            old_transitions_set = set(old_transitions)
+
+            # A transition needs its end states selected again if it is new,
+            # one of its end states is gone or a new state is attached to it.
+            for t in all_transitions:
+                if ((t not in old_transitions_set) or
+                    (t.pt1_state in removed_states) or (t.pt2_state in removed_states) or
+                    any(s.shape.is_attached(t.pt1) or s.shape.is_attached(t.pt2)
+                        for s in added_states)):
+                    t.select_end_states(all_states)
+        except Exception:
+            for e in old_shapes:
+                e[0].svg_shape = e[1]
+                if len(e) > 2:
+                    e[0].pt1_state, e[0].pt2_state = e[2], e[3]
+            raise
+
+        # Only the states enclosing or enclosed by an added/removed state can
+        # have a different hierarchy.
+        changed_states = added_states | removed_states
+        for s in all_states:
+            if (s in added_states) or any(s.shape.encloses(cs.shape) or cs.shape.encloses(s.shape)
+                                          for cs in changed_states):
+                s.select_sub_states(all_states)
+                s.select_parent_states(all_states)
+
+        self.svg = svg
+        self.svg_template = None
+        self.all_states = all_states
+        self.all_transitions = all_transitions
+        self.link_states()
+        print("Reloaded %s: %d state(s) and %d transition(s) changed." %
+              (self.svg_filename, len(changed_states),
+               len(set(all_transitions) ^ old_transitions_set)))
+        if self.lean:
+            self.release_svg(self.lean_keep_template)
 
     def get_path(self, state_start, state_dest):
         """ Given two states find the path to each other. This shows the border
@@ -654,11 +1232,475 @@ class StateChart(QSvgWidget):
 
         return path
 
+    def getSvgXML(self):
+        """ Serialize the SVG document as it is currently highlighted."""
+        if self.svg is None:
+            raise StateChartError("The SVG document of %s was released." % self.svg_filename)
+        xml = self.svg.getXML()
+        # Here we scrub the text content of the XML to make
+        # sure the special character < and & are properly escaped
+        # pysvg does not do this for us (bug).
+        xml_text_pat = re.compile(r"""<text.*?>(?P<text_data>.*?)</text\s*>""",
+        re.VERBOSE | re.MULTILINE | re.UNICODE |  re.DOTALL)
+        groups = xml_text_pat.findall(xml)
+        text_data_to_scrub = []
+        for i in range(len(groups)):
+            t_data = (u"%s" % groups[i])
+            if t_data:
+                if "<" in t_data or "&" in t_data:
+                    t_data_escaped = t_data.replace("&", "&amp;")
+                    t_data_escaped = t_data_escaped.replace("<", "&lt;")
+                    text_data_to_scrub.append((t_data, t_data_escaped))
+        for t0, t1 in text_data_to_scrub:
+            xml = xml.replace(t0, t1)
+        #with open("t0.svg", "w") as ofile:
+        #    ofile.write(xml)
+        return xml
+
+    def release_svg(self, keep_template=True):
+        """ Lean mode: drop the pysvg document and the references into it, only
+        the state chart model is kept for simulating. If keep_template is set,
+        an SvgTemplate is kept so the chart can still be rendered."""
+        self.check_not_shared()
+        if keep_template:
+            self.get_svg_template()
+        else:
+            self.svg_template = None
+        self.lean = True
+        self.lean_keep_template = keep_template
+        self.svg = None
+        # The svg_key digests stay, reload() matches the elements by them.
+        for e in self.all_states + self.all_transitions:
+            e.svg_shape = None
+
+    def share(self):
+        """ Mark the model shared, from now on it must not change. The
+        SvgTemplate is built first, building it on first use would briefly
+        rewrite the document others may be serializing."""
+        if self.svg is not None:
+            self.get_svg_template()
+        self.shared = True
+
+    def check_not_shared(self):
+        if self.shared:
+            raise StateChartError("The model of %s is shared, load it again "
+                                  "(see load_model) instead of changing it." % self.svg_filename)
+
+    def get_svg_template(self):
+        """ Return the SvgTemplate of the current diagram (built on first use)."""
+        if self.svg_template is None:
+            if self.svg is None:
+                raise StateChartError("The SVG document of %s was released." % self.svg_filename)
+            self.svg_template = SvgTemplate(self.all_states, self.all_transitions,
+                                            self.getSvgXML)
+        return self.svg_template
+
+
+_models = {}
+_models_lock = threading.Lock()
+
+
+def load_model(svg_filename):
+    """ Return the StateChartModel of the diagram, shared by every caller
+    loading the same file. The file is parsed again only once its
+    modification time or size changes, otherwise loading it costs a stat.
+    The model is marked shared: run it through StateChartInstance (or
+    StateChart(model=...)) objects, it refuses to reload() or release_svg().
+    Files are parsed outside the lock, so loading one file does not hold up
+    the others; if two threads parse the same file, the first one kept wins.
+    """
+    path = os.path.abspath(svg_filename)
+    st = os.stat(path)
+    key = (st.st_mtime_ns, st.st_size)
+    with _models_lock:
+        entry = _models.get(path)
+    if (entry is None) or (entry[0] != key):
+        model = StateChartModel(svg_filename)
+        model.share()
+        with _models_lock:
+            entry = _models.get(path)
+            if (entry is None) or (entry[0] != key):
+                entry = _models[path] = (key, model)
+    return entry[1]
+
+
+class StepMemo():
+    """ A bounded LRU cache of step results. A step only depends on the
+    current states and on the outcome of the transitions it evaluates, which
+    it evaluates in a fixed order given the outcomes so far. So for every
+    configuration (the current states in order) the memo keeps a decision
+    tree: each node is the next transition evaluated, each leaf the result
+    of the step. A cached step evaluates exactly the transitions the full
+    step would and then takes the result from the leaf. Steps that decided
+    something at random (a branch nobody took with the default context) are
+    not cached. At most max_size results are kept, the configurations used
+    least recently are dropped first.
+    """
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.trees = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.uncached = 0
+
+    def clear(self):
+        self.trees.clear()
+        self.size = 0
+
+    def stats(self):
+        """ Return the hit/miss statistics as a dictionary."""
+        n = self.hits + self.misses
+        return collections.OrderedDict([
+            ("hits", self.hits), ("misses", self.misses), ("uncached", self.uncached),
+            ("hit_ratio", float(self.hits)/n if n else 0.0),
+            ("configurations", len(self.trees)), ("results", self.size)])
+
+    def step(self, instance):
+        """ Take the step of the instance, from the memo if possible."""
+        key = tuple(instance.current_states)
+        entry = self.trees.get(key)
+        answers = []
+        node = None
+        if entry is not None:
+            self.trees.move_to_end(key)
+            # Decisions are lists [transition, node if false, node if true],
+            # results are tuples.
+            node = entry[0]
+            while isinstance(node, list):
+                outcome = bool(instance.eval_transition(node[0]))
+                answers.append((node[0], outcome))
+                node = node[1 + outcome]
+        if node is not None:
+            self.hits += 1
+            instance.current_states = list(node[0])
+            instance.highlighted_states = list(node[1])
+            instance.highlighted_transitions = list(node[2])
+            return
+
+        # Take the full step, the transitions already evaluated are answered
+        # in the same order and the ones after them are recorded.
+        self.misses += 1
+        evaluated = list(answers)
+        pending = list(reversed(answers))
+        eval_transition = instance.eval_transition
+        def memo_eval_transition(t):
+            if pending:
+                t0, outcome = pending.pop()
+                if t0 is t:
+                    return outcome
+                # Not the order of the last time, leave the memo alone.
+                del pending[:]
+                evaluated.append(None)
+            outcome = bool(eval_transition(t))
+            evaluated.append((t, outcome))
+            return outcome
+        instance.eval_transition = memo_eval_transition
+        instance.step_random = False
+        try:
+            instance.take_step()
+        finally:
+            del instance.eval_transition
+        if instance.step_random or (None in evaluated):
+            self.uncached += 1
+            return
+        self.insert(key, evaluated, (tuple(instance.current_states),
+                                     tuple(instance.highlighted_states),
+                                     tuple(instance.highlighted_transitions)))
+
+    def _count(self, node):
+        if isinstance(node, list):
+            return self._count(node[1]) + self._count(node[2])
+        return 0 if node is None else 1
+
+    def insert(self, key, evaluated, result):
+        """ Add the result of a step which evaluated the given (transition,
+        outcome) pairs in this order."""
+        entry = self.trees.get(key)
+        if entry is None:
+            entry = self.trees[key] = [None, 0]
+        self.trees.move_to_end(key)
+        # Walk down the decisions taken, whatever is in the way of the new
+        # path (only left by a change of the evaluation order) is replaced.
+        parent, index = entry, 0
+        for t, outcome in evaluated:
+            node = parent[index]
+            if not (isinstance(node, list) and (node[0] is t)):
+                removed = self._count(node)
+                entry[1] -= removed
+                self.size -= removed
+                node = parent[index] = [t, None, None]
+            parent, index = node, 1 + outcome
+        removed = self._count(parent[index])
+        parent[index] = result
+        entry[1] += 1 - removed
+        self.size += 1 - removed
+        while (self.size > self.max_size) and self.trees:
+            k, (tree, n) = self.trees.popitem(last=False)
+            self.size -= n
+
+
+StateChartSnapshot = collections.namedtuple("StateChartSnapshot", [
+    "current_states", "highlighted_states", "highlighted_transitions",
+    "time", "timers", "timer_serials", "expired_timers", "context"])
+
+
+class StateChartInstance():
+    """ One run of a StateChartModel: the current states, the states and
+    transitions taken by the last step, the context object deciding the
+    transitions and the timers. Instances are small, many of them can run
+    on one shared model.
+    """
+    def __init__(self, model, context_object=None):
+        self.model = model
+        # Enter the state chart through the initial states
+        self.current_states = list(model.top_init_states)
+        self.highlighted_states = []
+        self.highlighted_transitions = []
+        if context_object is None:
+            context_object = StateChartContextDefault()
+        self.context_object = context_object
+        # Timers of after(N) transitions, only used once a clock is set.
+        self.clock = None
+        self.timers = []
+        self.timer_serials = {}
+        self.expired_timers = set()
+        # While set, the only transition out of the active states taken.
+        self.forced_transition = None
+        # Optional StepMemo, see set_step_memo.
+        self.step_memo = None
+        # Set by a step which decided something at random.
+        self.step_random = False
+
+    def configure(self, context_object=None, initial_states=None):
+        """ Given the context object and initial states (fully qualified
+        names), the state chart is configured.
+        """
+        if context_object != None:
+            self.context_object = context_object
+
+        if initial_states != None:
+            current_states = []
+            for si in initial_states:
+                states = self.model.states_by_full_name.get(si.strip(), [])
+                if not states:
+                    print("Warning: No state named [%s]." % si.strip())
+                current_states += states
+            if current_states:
+                self.current_states = current_states
+                if self.clock is not None:
+                    self.reset_timers()
+
+    def find_states(self, full_names):
+        """ Return the states with the given fully qualified names, each state
+        at most once, names not in the model are skipped."""
+        states_by_full_name = dict((k, list(v)) for k, v in self.model.states_by_full_name.items())
+        states = []
+        for name in full_names:
+            if states_by_full_name.get(name.strip()):
+                states.append(states_by_full_name[name.strip()].pop(0))
+        return states
+
+    def get_active_states(self):
+        """ Return the active configuration: the current states and all their
+        ancestors, outer most states first."""
+        active_states = set(self.current_states)
+        for s in self.current_states:
+            active_states.update(s.parent_states)
+        return sorted(active_states, key=lambda s: s.order)
+
+    def eval_transition(self, t):
+        """ Check if the transition can be taken. Timeout transitions are
+        decided by the timers once a clock is set, all others by the context
+        object. A guard on a timeout transition is still evaluated by the
+        context object once the timer has run out."""
+        if (self.forced_transition is not None) and \
+           ((t.pt1_state.name != State.BRANCH_NAME) or (t.pt1_state in self.current_states)):
+            return t is self.forced_transition
+        if (t.timeout is not None) and (self.clock is not None):
+            if t not in self.expired_timers:
+                return False
+            return (not t.guard) or self.context_object.eval("", t.guard)
+        return self.context_object.eval(t.trigger, t.guard)
+
+    def fire_transition(self, transition):
+        """ Advance one step taking the given transition: it is considered
+        true and every other transition out of the active states (an active
+        branch pseudo-state included) false, the branch pseudo-states entered
+        on the way decide as usual. Return False (and do nothing) if its
+        source state is not active."""
+        if not (self._active_mask(self.current_states) & transition.pt1_state.bit):
+            return False
+        self.forced_transition = transition
+        try:
+            self.advance_state()
+        finally:
+            self.forced_transition = None
+        return True
+
+    def set_step_memo(self, step_memo):
+        """ Look up the steps in the given StepMemo (None to stop). One memo
+        can be shared by the instances of a model."""
+        self.step_memo = step_memo
+
+    def set_clock(self, clock):
+        """ Drive the after(N) transitions from the given clock (VirtualClock or
+        RealClock), the timers of the active states start now."""
+        self.clock = clock
+        self.reset_timers()
+
+    def _active_mask(self, states):
+        mask = 0
+        for s in states:
+            mask |= s.bit | s.ancestors_mask
+        return mask
+
+    def reset_timers(self):
+        """ Forget all the timers and arm the ones of the active states."""
+        self.timers = []
+        self.timer_serials = {}
+        self.expired_timers = set()
+        if self.clock is not None:
+            self.arm_timers(self.get_active_states())
+
+    def arm_timers(self, states):
+        """ Start the timers of the timeout transitions out of the states which
+        are being entered, restarting them if they were already running."""
+        now = self.clock.now()
+        for s in states:
+            serial = self.timer_serials.get(s, 0) + 1
+            self.timer_serials[s] = serial
+            for t in s.out_transitions:
+                self.expired_timers.discard(t)
+                if t.timeout is not None:
+                    heapq.heappush(self.timers, (now + t.timeout, id(t), serial, s, t))
+
+    def update_timers(self, previous_states):
+        """ After a step stop the timers of the exited states and start the
+        ones of the entered states."""
+        active = self._active_mask(self.current_states)
+        entered = set(t.pt2_state for t in self.highlighted_transitions)
+        for s in list(self.timer_serials):
+            if not (active & s.bit):
+                del self.timer_serials[s]
+                for t in s.out_transitions:
+                    self.expired_timers.discard(t)
+        previous_active = self._active_mask(previous_states)
+        self.arm_timers([s for s in self.get_active_states()
+                         if (s in entered) or not (previous_active & s.bit)])
+
+    def expire_timers(self):
+        """ Move the timers whose deadline has passed to expired_timers."""
+        now = self.clock.now()
+        while self.timers and self.timers[0][0] <= now:
+            deadline, _, serial, s, t = heapq.heappop(self.timers)
+            if self.timer_serials.get(s) == serial:
+                self.expired_timers.add(t)
+
+    def next_deadline(self):
+        """ Return the time of the next running timer or None."""
+        while self.timers:
+            deadline, _, serial, s, t = self.timers[0]
+            if self.timer_serials.get(s) == serial:
+                return deadline
+            heapq.heappop(self.timers)
+        return None
+
+    def snapshot(self):
+        """ Capture where this run is: the current states, what the last step
+        highlighted, the clock time and the timers. If the context object has
+        snapshot() and restore() methods its snapshot is included. The states
+        and transitions are referenced, not copied, the model is shared."""
+        context = None
+        if hasattr(self.context_object, "snapshot"):
+            context = self.context_object.snapshot()
+        return StateChartSnapshot(tuple(self.current_states),
+                                  tuple(self.highlighted_states),
+                                  tuple(self.highlighted_transitions),
+                                  None if self.clock is None else self.clock.now(),
+                                  tuple(self.timers),
+                                  tuple(self.timer_serials.items()),
+                                  frozenset(self.expired_timers),
+                                  context)
+
+    def restore(self, snapshot):
+        """ Go back to a snapshot taken of this instance or of another
+        instance of the same model. A VirtualClock is set back to the time of
+        the snapshot."""
+        self.current_states = list(snapshot.current_states)
+        self.highlighted_states = list(snapshot.highlighted_states)
+        self.highlighted_transitions = list(snapshot.highlighted_transitions)
+        if (snapshot.time is not None) and isinstance(self.clock, VirtualClock):
+            self.clock.set_time(snapshot.time)
+        # The timers were captured in heap order.
+        self.timers = list(snapshot.timers)
+        self.timer_serials = dict(snapshot.timer_serials)
+        self.expired_timers = set(snapshot.expired_timers)
+        if snapshot.context is not None:
+            self.context_object.restore(snapshot.context)
+
+    def fork(self, snapshot=None):
+        """ Return a new StateChartInstance of the same model continuing from
+        the snapshot (by default from where this instance is). The fork gets
+        its own VirtualClock and, if the context object supports snapshots, a
+        copy of the context object restored from it. Other context objects
+        are shared with the fork."""
+        if snapshot is None:
+            snapshot = self.snapshot()
+        context_object = self.context_object
+        if snapshot.context is not None:
+            context_object = copy.copy(context_object)
+        instance = StateChartInstance(self.model, context_object)
+        instance.step_memo = self.step_memo
+        if isinstance(self.clock, VirtualClock):
+            instance.clock = VirtualClock(self.clock.now())
+        else:
+            instance.clock = self.clock
+        instance.restore(snapshot)
+        return instance
+
+    def advance_time(self, seconds, max_steps=None):
+        """ With a VirtualClock, let the given time pass. The clock jumps from
+        one timer deadline to the next and the state machine advances one step
+        at each of them. A chart still in its init pseudo-states first takes
+        one step out of them, no timer is armed before that. Return the
+        number of steps taken."""
+        if not isinstance(self.clock, VirtualClock):
+            raise StateChartError("advance_time needs a VirtualClock.")
+        t_end = self.clock.now() + seconds
+        n_steps = 0
+        if ((max_steps is None) or (max_steps > 0)) and \
+           [s for s in self.current_states if s.name == State.INIT_NAME]:
+            self.advance_state()
+            n_steps += 1
+        while (max_steps is None) or (n_steps < max_steps):
+            deadline = self.next_deadline()
+            if (deadline is None) or (deadline > t_end):
+                break
+            self.clock.set_time(max(deadline, self.clock.now()))
+            self.advance_state()
+            n_steps += 1
+        self.clock.set_time(max(t_end, self.clock.now()))
+        return n_steps
 
     def advance_state(self, environment = {}):
         """ This state machine advances the state machine based on the truth
         values of the transitions for the current states.
         """
+        previous_states = self.current_states
+        if self.clock is not None:
+            self.expire_timers()
+        if self.step_memo is not None:
+            self.step_memo.step(self)
+        else:
+            self.take_step()
+        if self.clock is not None:
+            self.update_timers(previous_states)
+
+    def take_step(self):
+        """ Take the transitions out of the current states: update the current
+        states and the highlighted states and transitions.
+        """
         # Also find the common ancestors of any combinations of the
         # current states. We need to check transitions out of these
         # common ancestors before we go into the current state transitions.
@@ -686,7 +1728,7 @@ class StateChart(QSvgWidget):
                 transitions += s.out_transitions
             #Evaluate each transtion... but for now select one random one.
             for t in transitions:
-                if self.context_object.eval(t.trigger, t.guard):
+                if self.eval_transition(t):
                     candidate_transitions0.append(t)
                     candidate_destinations.append(t.pt2_state)
         #for t in candidate_transitions0:
@@ -708,7 +1750,7 @@ class StateChart(QSvgWidget):
                     break
                 # Evaluate each transtion
                 for t in s.out_transitions:
-                    if self.context_object.eval(t.trigger, t.guard):
+                    if self.eval_transition(t):
                         candidate_transitions1.append([s,t])
                         current_states_exited.append(s)
                         break
@@ -725,30 +1767,25 @@ class StateChart(QSvgWidget):
         # moves in such a way that it causes an exit or entry of another states
         # parent. If a transitions exits s111, to s0 then s12 can be affected if
         # s1 is a parent/grandparent of s12 and s111.
-        candidate_transitions1_path = collections.OrderedDict()
-        candidate_transitions1_exited_states = collections.OrderedDict()
-        candidate_transitions1_entered_states = collections.OrderedDict()
+        # The states crossed by the path of every (state, transition) pair are
+        # precomputed as a bit mask (see build_transition_tables), so this is
+        # a test of that mask against the other state's ancestors mask.
+        # The pairs are still compared with each other (quadratic in the
+        # number of current states) rather than through a single conflict
+        # table: a state adopting a transition changes what the later pairs
+        # see, and that order dependent outcome is kept as it was.
+        candidate_transitions1_regions = collections.OrderedDict()
         for s,t in candidate_transitions1:
-            candidate_transitions1_path[s] = self.get_path(s, t.pt2_state)
-            candidate_transitions1_exited_states[s] = []
-            candidate_transitions1_entered_states[s] = []
-            for p in candidate_transitions1_path[s]:
-                if p[0] == "exit":
-                    candidate_transitions1_exited_states[s].append(p[2])
-                elif p[0] == "enter":
-                    candidate_transitions1_entered_states[s].append(p[2])
+            candidate_transitions1_regions[s] = self.model.get_transition_region(s, t)
 
         for s,t in candidate_transitions1:
+            region = candidate_transitions1_regions[s]
             for sstt in candidate_transitions1:
                 ss,tt = sstt
                 if (ss == s) or (tt == t):
                     continue
-                exited_parent_states = list(set(ss.parent_states) & set(candidate_transitions1_exited_states[s]))
-                entered_parent_states = list(set(ss.parent_states) & set(candidate_transitions1_entered_states[s]))
                 # TODO: Adopting the transition might not be the right thing to do.
-                if(entered_parent_states):
-                    sstt[1] = t
-                elif(exited_parent_states):
+                if ss.ancestors_mask & region:
                     sstt[1] = t
 
         # Check if we need to transition out some states that did not have
@@ -757,13 +1794,12 @@ class StateChart(QSvgWidget):
         current_states_exited_augment = []
         for st in candidate_transitions1:
             s,t = st
+            region = candidate_transitions1_regions[s]
             for ss in current_states_notexited:
                 if (ss == s):
                     continue
-                exited_parent_states = list(set(ss.parent_states) & set(candidate_transitions1_exited_states[s]))
-                entered_parent_states = list(set(ss.parent_states) & set(candidate_transitions1_entered_states[s]))
                 # TODO: Adopting the transition might not be the right thing to do.
-                if(entered_parent_states) or (exited_parent_states):
+                if ss.ancestors_mask & region:
                     candidate_transitions1_augment.append([ss,t])
                     current_states_exited_augment.append(ss)
         candidate_transitions1 += candidate_transitions1_augment
@@ -780,27 +1816,13 @@ class StateChart(QSvgWidget):
             for s,t in candidate_transitions1:
                 if st[0] == s:
                     continue
-                if t.pt1_state in s.parent_states:
+                if t.pt1_state.bit & s.ancestors_mask:
                     st[1] = t
         candidate_transitions2 = []
         for s,t in candidate_transitions1:
             candidate_transitions2.append(t)
         candidate_transitions2 = list(set(candidate_transitions2))
 
-        # Repeat the path calculations on the final candidates.
-        candidate_transitions2_path = collections.OrderedDict()
-        candidate_transitions2_exited_states = collections.OrderedDict()
-        candidate_transitions2_entered_states = collections.OrderedDict()
-        for s,t in candidate_transitions1:
-            candidate_transitions2_path[s] = self.get_path(s, t.pt2_state)
-            candidate_transitions2_exited_states[s] = []
-            candidate_transitions2_entered_states[s] = []
-            for p in candidate_transitions2_path[s]:
-                if p[0] == "exit":
-                    candidate_transitions2_exited_states[s].append(p[2])
-                elif p[0] == "enter":
-                    candidate_transitions2_entered_states[s].append(p[2])
-
         # Now highligt the out transitions
         highlighted_transitions = []
         highlighted_states1 = []
@@ -814,15 +1836,19 @@ class StateChart(QSvgWidget):
         # we need to land. See if the entered states are init states.
         # If yes... then follow through until reaching a substate that does
         # not contain an init state.
+        # The part of this that does not involve branches is precomputed (see
+        # build_entry_closures), only continue from where that stopped.
         highlighted_states2 = []
         current_states = []
-        entered_states = {}
         for ss in highlighted_states1:
-            entered_states[ss] = []
-            cs1 = [ss]
+            transitions, states, cs1, done = ss.default_entry
+            highlighted_transitions += transitions
+            highlighted_states2 += states
+            if done:
+                current_states += cs1
+                continue
             while True:
                 no_init_state = True
-                entered_states[ss] += cs1
                 cs2 = list(cs1)
                 cs1 = []
                 for s in cs2:
@@ -830,7 +1856,7 @@ class StateChart(QSvgWidget):
                     if s.name == State.BRANCH_NAME:
                         tt = None
                         for t in s.out_transitions:
-                            if self.context_object.eval(t.trigger, t.guard):
+                            if self.eval_transition(t):
                                 tt = t
                                 break
                         if not tt:
@@ -838,6 +1864,7 @@ class StateChart(QSvgWidget):
                             # If using the default context, take a random selection.
                             if(isinstance(self.context_object, StateChartContextDefault)):
                                 tt = random.choice(s.out_transitions)
+                                self.step_random = True
                         if tt:
                             highlighted_transitions.append(tt)
                             highlighted_states2.append(tt.pt2_state)
@@ -864,7 +1891,203 @@ class StateChart(QSvgWidget):
         self.highlighted_states = highlighted_states1 + highlighted_states2 + current_states_notexited
         self.current_states = current_states + current_states_notexited
 
+
+class StateChartWorker(threading.Thread):
+    """ Steps a StateChartInstance on its own thread. After every step
+    publish(step_count, snapshot) is called (on the worker thread) with a
+    StateChartSnapshot, which is immutable and safe to hand to other threads.
+    """
+    def __init__(self, instance, publish, interval_ms=0, step=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.instance = instance
+        self.publish = publish
+        self.interval = interval_ms/1000.0
+        self.step = step
+        self.step_count = 0
+        self.error = None
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                if self.step:
+                    self.step(self.instance)
+                else:
+                    self.instance.advance_state()
+            except Exception as e:
+                self.error = e
+                print("Warning: state chart worker stopped: %s" % e)
+                break
+            self.step_count += 1
+            self.publish(self.step_count, self.instance.snapshot())
+            if self.interval:
+                self.stop_event.wait(self.interval)
+
+    def stop(self):
+        """ Stop stepping and wait for the step in progress to finish."""
+        self.stop_event.set()
+        if self is not threading.current_thread():
+            self.join()
+
+
+class StateChart(QSvgWidget, StateChartInstance):
+    """ A Qt view of a state chart: the SVG diagram with the states and
+    transitions of the last step highlighted. The diagram is loaded into a
+    StateChartModel and the chart runs as a StateChartInstance of it.
+    Given a model (e.g. from load_model) the chart shares it instead: the
+    shared SVG document is left as it is and every frame is rendered from
+    the model's SvgTemplate.
+    """
+    # Emitted by the worker thread, delivered on the GUI thread.
+    step_published = Signal()
+    # Layered rendering: raster tile size and how many zoom levels are kept.
+    TILE_SIZE = 256
+    MAX_CACHED_ZOOMS = 4
+    highlight_color = "red"
+
+    def __init__(self, svg_filename="", parent=None, model=None):
+        QSvgWidget.__init__(self, parent=None)
+        self.shared_model = model is not None
+        if model is None:
+            model = StateChartModel(svg_filename)
+        else:
+            model.share()
+        StateChartInstance.__init__(self, model)
+        # What the SVG document currently shows highlighted.
+        self.drawn_states = []
+        self.drawn_transitions = []
+        self.listeners = []
+        self.timeout_step_timer = None
+        self.watcher = None
+        self.reload_timer = None
+
+        # The model may step much faster than the SVG can be rendered, so
+        # repaints are limited to max_fps and only show the latest step.
+        # Set show_every_step to render each step (e.g. for debugging).
+        self.max_fps = 30
+        self.show_every_step = False
+        self.step_count = 0
+        self.frame_count = 0
+        self.last_render_time = 0
+        self.render_timer = QTimer(self)
+        self.render_timer.setSingleShot(True)
+        self.render_timer.timeout.connect(self.render_frame)
+        self.step_timer = None
+        # Stepping on a worker thread, see run_in_thread.
+        self.worker = None
+        self.worker_step_base = 0
+        self.published = None
+        self.publish_pending = False
+        self.step_published.connect(self._show_published)
+        self.selected_state = None
+        # Layered rendering, see set_layered.
+        self.layered = False
+        self.layer_tiles = collections.OrderedDict()
+        self.layer_drawn = set()
+
+        self.highlight_states(self.current_states)
+        self.highlight_transitions(self.highlighted_transitions)
+
+    def __getattr__(self, name):
+        # The diagram (all_states, svg, get_state(), ...) lives in the model.
+        model = self.__dict__.get("model")
+        if model is None:
+            raise AttributeError(name)
+        return getattr(model, name)
+
+    def reload(self):
+        """ Re-read the SVG file after it has been edited and exported again,
+        see StateChartModel.reload. The current states are carried over by
+        their fully qualified name. A worker thread (see run_in_thread) steps
+        a fork on the same model, it is stopped while the model changes and
+        started again afterwards.
+        """
+        worker = self.worker
+        if worker is not None:
+            self.run_in_thread(False)
+        try:
+            self._reload_model()
+        finally:
+            if worker is not None:
+                self.run_in_thread(True, worker.interval*1000.0, worker.step)
+
+    def _reload_model(self):
+        current_names = [s.full_name() for s in self.current_states]
+        if self.shared_model:
+            # Others run on the same model, switch to the new one instead.
+            self.model = load_model(self.svg_filename)
+        else:
+            self.model.reload()
+        if self.step_memo is not None:
+            self.step_memo.clear()
+        current_states = self.find_states(current_names)
+        if not current_states:
+            current_states = list(self.model.top_init_states)
+        self.current_states = current_states
+        if self.clock is not None:
+            self.reset_timers()
+        self.highlighted_states = list(current_states)
+        self.highlighted_transitions = []
+        self.highlight_states(self.highlighted_states)
+        self.highlight_transitions(self.highlighted_transitions)
+        if self.layered:
+            self.set_layered()
+        else:
+            self.refresh()
+
+    def watch(self, enable=True):
+        """ Reload the state chart whenever its SVG file changes on disk.
+        """
+        if not enable:
+            if self.watcher:
+                self.watcher.removePath(self.svg_filename)
+            return
+        if self.watcher is None:
+            self.watcher = QFileSystemWatcher(self)
+            self.watcher.fileChanged.connect(self._svg_file_changed)
+            # Exporting can touch the file more than once, wait for it to settle.
+            self.reload_timer = QTimer(self)
+            self.reload_timer.setSingleShot(True)
+            self.reload_timer.setInterval(200)
+            self.reload_timer.timeout.connect(self._reload_svg_file)
+        self.watcher.addPath(self.svg_filename)
+
+    def _svg_file_changed(self, path):
+        self.reload_timer.start()
+
+    def _reload_svg_file(self):
+        # Some editors replace the file which drops it from the watcher.
+        if self.svg_filename not in self.watcher.files():
+            self.watcher.addPath(self.svg_filename)
+        try:
+            self.reload()
+        except Exception as e:
+            print("Warning: could not reload %s: %s" % (self.svg_filename, e))
+
+    def configure(self, context_object=None, initial_states=None):
+        """ Given the context object and initial states, the state chart is
+        configured.
+        """
+        current_states = self.current_states
+        StateChartInstance.configure(self, context_object, initial_states)
+        if self.current_states is not current_states:
+            self.highlight_states(self.current_states)
+            self.highlight_transitions([])
+            self.refresh()
+
+    def set_clock(self, clock):
+        StateChartInstance.set_clock(self, clock)
+        self.schedule_timeout_step()
+
+    def restore(self, snapshot):
+        StateChartInstance.restore(self, snapshot)
+        self.schedule_render()
+        self.schedule_timeout_step()
+
     def highlight_states(self, states):
+        self.drawn_states = list(states)
+        if (self.svg is None) or self.layered or self.shared_model:
+            return
         for s in self.all_states:
             if s in states:
                 highlight_color = "red"
@@ -873,6 +2096,9 @@ class StateChart(QSvgWidget):
             s.highlight(highlight_color)
 
     def highlight_transitions(self, transitions):
+        self.drawn_transitions = list(transitions)
+        if (self.svg is None) or self.layered or self.shared_model:
+            return
         for t in self.all_transitions:
             if t in transitions:
                 highlight_color = "red"
@@ -881,39 +2107,294 @@ class StateChart(QSvgWidget):
             t.highlight(highlight_color)
 
     def getSvgXML(self):
-        xml = self.svg.getXML()
-        # Here we scrub the text content of the XML to make
-        # sure the special character < and & are properly escaped
-        # pysvg does not do this for us (bug).
-        xml_text_pat = re.compile(r"""<text.*?>(?P<text_data>.*?)</text\s*>""",
-        re.VERBOSE | re.MULTILINE | re.UNICODE |  re.DOTALL)
-        groups = xml_text_pat.findall(xml)
-        text_data_to_scrub = []
-        for i in range(len(groups)):
-            t_data = (u"%s" % groups[i])
-            if t_data:
-                if "<" in t_data or "&" in t_data:
-                    t_data_escaped = t_data.replace("&", "&amp;")
-                    t_data_escaped = t_data_escaped.replace("<", "&lt;")
-                    text_data_to_scrub.append((t_data, t_data_escaped))
-        for t0, t1 in text_data_to_scrub:
-            xml = xml.replace(t0, t1)
-        #with open("t0.svg", "w") as ofile:
-        #    ofile.write(xml)
-        return xml
+        if (self.svg is None) or self.shared_model:
+            # Lean mode or a shared model, render the template of the document.
+            return self.get_svg_template().render(self.drawn_states + self.drawn_transitions)
+        return self.model.getSvgXML()
 
     def refresh(self, defaultviewsize=False):
-        xml = self.getSvgXML()
-        svg_ba = QByteArray(bytes(xml,'utf-8'))
-        self.load(svg_ba)
-        if defaultviewsize:
-            #  This will make sure diagram is shown full scale.
-            self.resize(self.sizeHint())
+        if self.layered:
+            self.update_layers()
+        elif (self.svg is not None) or (self.svg_template is not None):
+            xml = self.getSvgXML()
+            svg_ba = QByteArray(bytes(xml,'utf-8'))
+            self.load(svg_ba)
+            if defaultviewsize:
+                #  This will make sure diagram is shown full scale.
+                self.resize(self.sizeHint())
+        for listener in self.listeners:
+            listener(self.drawn_states, self.drawn_transitions)
+
+    def set_layered(self, enable=True):
+        """ Layered rendering: the diagram without highlights is rasterized
+        once per zoom level into cached tiles and the highlighted states and
+        transitions are drawn over it from the model geometry. A step only
+        repaints the elements whose highlight changed and painting skips the
+        tiles and elements outside the exposed area, so the cost of a step
+        does not grow with the diagram."""
+        if enable:
+            # The static diagram stays loaded in the renderer of the widget.
+            xml = self.get_svg_template().render([])
+            self.load(QByteArray(bytes(xml, 'utf-8')))
+            self.layer_tiles.clear()
+            self.layer_drawn = set()
+            self.layered = True
+            self.update()
+        else:
+            self.layered = False
+            self.layer_tiles.clear()
+            self.highlight_states(self.drawn_states)
+            self.highlight_transitions(self.drawn_transitions)
+        self.refresh()
 
-    def mousePressEvent(self, event):
-        print(event.x(), event.y())
+    def set_zoom(self, factor):
+        """ Resize the view to the given multiple of the diagram size, e.g.
+        when it is inside a QScrollArea."""
+        self.resize(self.renderer().defaultSize()*factor)
+
+    def _layer_transform(self):
+        # Scale and offset mapping diagram to widget coordinates.
+        vb = self.renderer().viewBoxF()
+        if vb.isEmpty():
+            return (1.0, 1.0, 0.0, 0.0)
+        sx = self.width()/vb.width()
+        sy = self.height()/vb.height()
+        return (sx, sy, -vb.x()*sx, -vb.y()*sy)
+
+    def _layer_rect(self, bounds, transform):
+        # Widget rectangle covering the element bounds, with room for the pen.
+        sx, sy, dx, dy = transform
+        x1, y1, x2, y2 = bounds
+        return QRectF(x1*sx + dx - 2*sx - 1, y1*sy + dy - 2*sy - 1,
+                      (x2 - x1 + 4)*sx + 2, (y2 - y1 + 4)*sy + 2).toAlignedRect()
+
+    def update_layers(self):
+        """ Schedule the repaint of the elements whose highlight changed."""
+        drawn = set(self.drawn_states) | set(self.drawn_transitions)
+        transform = self._layer_transform()
+        for e in drawn ^ self.layer_drawn:
+            self.update(self._layer_rect(e.shape.bounds() if isinstance(e, State) else e.bounds(),
+                                         transform))
+        self.layer_drawn = drawn
+
+    def _get_tile(self, i, j):
+        key = (self.width(), self.height())
+        tiles = self.layer_tiles.get(key)
+        if tiles is None:
+            tiles = self.layer_tiles[key] = {}
+            while len(self.layer_tiles) > self.MAX_CACHED_ZOOMS:
+                self.layer_tiles.popitem(last=False)
+        else:
+            self.layer_tiles.move_to_end(key)
+        tile = tiles.get((i, j))
+        if tile is None:
+            n = self.TILE_SIZE
+            tile = QImage(n, n, QImage.Format_ARGB32_Premultiplied)
+            tile.fill(0)
+            painter = QPainter(tile)
+            painter.translate(-i*n, -j*n)
+            self.renderer().render(painter, QRectF(0, 0, self.width(), self.height()))
+            painter.end()
+            tiles[(i, j)] = tile
+        return tile
+
+    def paintEvent(self, event):
+        if not self.layered:
+            QSvgWidget.paintEvent(self, event)
+            return
+        rect = event.rect()
+        transform = self._layer_transform()
+        painter = QPainter(self)
+        n = self.TILE_SIZE
+        for i in range(max(0, rect.left()//n), rect.right()//n + 1):
+            for j in range(max(0, rect.top()//n), rect.bottom()//n + 1):
+                painter.drawImage(i*n, j*n, self._get_tile(i, j))
+
+        sx, sy, dx, dy = transform
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.translate(dx, dy)
+        painter.scale(sx, sy)
+        painter.setPen(QPen(QColor(self.highlight_color), 1.0))
+        painter.setBrush(Qt.NoBrush)
+        for e in self.layer_drawn:
+            if isinstance(e, State):
+                if not rect.intersects(self._layer_rect(e.shape.bounds(), transform)):
+                    continue
+                if isinstance(e.shape, DiagramCircle):
+                    painter.drawEllipse(QPointF(e.shape.center.x, e.shape.center.y),
+                                        e.shape.radius, e.shape.radius)
+                elif not e.shape.rotation_angle:
+                    x1, y1, x2, y2 = e.shape.bounds()
+                    painter.drawRoundedRect(QRectF(x1, y1, x2 - x1, y2 - y1), e.shape.rx, e.shape.ry)
+                else:
+                    painter.drawPolygon(QPolygonF([QPointF(p.x, p.y) for p in e.shape.corners()]))
+            else:
+                if not rect.intersects(self._layer_rect(e.bounds(), transform)):
+                    continue
+                for x1, y1, x2, y2 in e.segments:
+                    painter.drawLine(QPointF(x1, y1), QPointF(x2, y2))
+        painter.end()
+
+    def resizeEvent(self, event):
+        QSvgWidget.resizeEvent(self, event)
+        if self.layered:
+            self.update()
+
+    def add_listener(self, listener):
+        """ Call listener(states, transitions) with the highlighted states and
+        transitions every time the state chart view is refreshed."""
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def step(self):
+        """ Advance the state machine one step and schedule the view update.
+        While a worker thread is stepping, it owns the state machine and this
+        does nothing."""
+        if self.worker is not None:
+            return
         self.advance_state()
+        self.step_taken()
+
+    def step_taken(self, n_steps=1):
+        self.step_count += n_steps
+        self.schedule_render()
+        self.schedule_timeout_step()
+
+    def advance_time(self, seconds, max_steps=None):
+        """ See StateChartInstance.advance_time, the view shows the last step."""
+        if self.worker is not None:
+            return 0
+        n_steps = StateChartInstance.advance_time(self, seconds, max_steps)
+        if n_steps:
+            self.step_taken(n_steps)
+        return n_steps
+
+    def fire_transition(self, transition):
+        """ Advance one step taking the given transition, see
+        StateChartInstance.fire_transition."""
+        if self.worker is not None:
+            return False
+        if not StateChartInstance.fire_transition(self, transition):
+            print("Transition [%s] is not enabled." % transition.text.strip())
+            return False
+        self.step_taken()
+        return True
+
+    def select_state(self, state):
+        """ Make the state the selected one and print what it is."""
+        self.selected_state = state
+        active = bool(self._active_mask(self.current_states) & state.bit)
+        print("State [%s]: %s, out transitions %s" %
+              (state.full_name(), "active" if active else "not active",
+               [t.text.strip() for t in state.out_transitions]))
+
+    def schedule_timeout_step(self):
+        """ With a RealClock, make sure the next step happens when the next
+        timer runs out."""
+        if not isinstance(self.clock, RealClock):
+            return
+        deadline = self.next_deadline()
+        if deadline is None:
+            return
+        if self.timeout_step_timer is None:
+            self.timeout_step_timer = QTimer(self)
+            self.timeout_step_timer.setSingleShot(True)
+            self.timeout_step_timer.setTimerType(Qt.PreciseTimer)
+            self.timeout_step_timer.timeout.connect(self.step)
+        self.timeout_step_timer.start(max(0, int(math.ceil((deadline - self.clock.now())*1000))))
+
+    def schedule_render(self):
+        """ Render the latest step now or, if a frame was rendered less than
+        1/max_fps ago, once that time is up. Steps taken in the mean time
+        are not drawn."""
+        if self.show_every_step:
+            self.render_frame()
+            return
+        if self.render_timer.isActive():
+            return
+        wait = self.last_render_time + 1.0/self.max_fps - time.monotonic()
+        self.render_timer.start(max(0, int(wait*1000)))
+
+    def render_frame(self):
+        """ Draw the highlighted states and transitions of the latest step.
+        (Not render(), that is QWidget.render painting the widget elsewhere.)"""
+        self.render_timer.stop()
         self.highlight_states(self.highlighted_states)
         self.highlight_transitions(self.highlighted_transitions)
         self.refresh()
+        self.frame_count += 1
+        self.last_render_time = time.monotonic()
+
+    def run(self, enable=True, interval_ms=0):
+        """ Keep stepping the state machine every interval_ms (as fast as the
+        event loop allows by default) independent of the rendering."""
+        if self.step_timer is None:
+            self.step_timer = QTimer(self)
+            self.step_timer.timeout.connect(self.step)
+        if enable:
+            self.step_timer.start(interval_ms)
+        else:
+            self.step_timer.stop()
+
+    def run_in_thread(self, enable=True, interval_ms=0, step=None):
+        """ Step the state machine on a worker thread (see StateChartWorker)
+        every interval_ms, or as fast as it can by default. The worker runs a
+        fork of this chart and publishes every step as a snapshot, this view
+        swaps the latest one in and renders it on the GUI thread, so a slow
+        context object does not freeze the GUI. step(instance) can replace
+        instance.advance_state() as the work done per step. Once stopped, the
+        chart carries on from the last step of the worker.
+        """
+        if not enable:
+            if self.worker is not None:
+                self.worker.stop()
+                self._show_published()
+                self.worker = None
+                self.published = None
+            return
+        if self.worker is None:
+            self.worker_step_base = self.step_count
+            self.worker = StateChartWorker(self.fork(), self._publish, interval_ms, step)
+            self.worker.start()
+
+    def _publish(self, step_count, snapshot):
+        # On the worker thread: replacing the reference swaps the buffers,
+        # the GUI thread is only woken up if it took the previous step.
+        self.published = (step_count, snapshot)
+        if not self.publish_pending:
+            self.publish_pending = True
+            self.step_published.emit()
+
+    def _show_published(self):
+        self.publish_pending = False
+        published = self.published
+        if published is None:
+            return
+        step_count, snapshot = published
+        StateChartInstance.restore(self, snapshot)
+        self.step_count = self.worker_step_base + step_count
+        self.schedule_render()
+
+    def map_to_diagram(self, x, y):
+        """ Map a point of the widget to diagram coordinates, the diagram's
+        view box is stretched over the whole widget."""
+        vb = self.renderer().viewBoxF()
+        if (self.width() <= 0) or (self.height() <= 0) or vb.isEmpty():
+            return (x, y)
+        return (vb.x() + x*vb.width()/self.width(), vb.y() + y*vb.height()/self.height())
+
+    def mousePressEvent(self, event):
+        """ Clicking a transition fires it, clicking a state selects it and
+        clicking anywhere else advances the state machine one step."""
+        x, y = self.map_to_diagram(event.x(), event.y())
+        e = self.model.element_at(x, y)
+        print(event.x(), event.y(), "->", x, y)
+        if isinstance(e, Transition):
+            self.fire_transition(e)
+        elif isinstance(e, State):
+            self.select_state(e)
+        else:
+            self.step()
 
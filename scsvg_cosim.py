@@ -0,0 +1,206 @@
+#-------------------------------------------------------------------------------
+# Copyright (C) 07/2020 Eyob Demissie
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in 
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A 
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THETHE AUTHORS OR 
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER 
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# 
+# Except as contained in this notice, the name(s) of the above copyright holders 
+# shall not be used in advertising or otherwise to promote the sale, use or other
+# dealings in this Software without prior written authorization.
+#-------------------------------------------------------------------------------
+"""
+Co-simulate many state charts that send events to each other, without Qt.
+
+Every chart is a StateChartInstance, charts of the same diagram share one
+StateChartModel. Transitions are labelled 'event [guard] / action': the
+trigger is the name of the event being delivered (an empty trigger is taken
+with any event), the guard is evaluated in the chart's variables and the
+action is run in them. Actions send events with send(chart, event, delay=0,
+priority=0), e.g.
+
+    go [cars > 0] / send("crossing", "busy", delay=0.5)
+
+Events wait in one priority queue ordered by (time, priority, sending order)
+and only the chart an event is for is stepped, so thousands of charts can
+run in one process. Time is a VirtualClock shared by all the charts, which
+also drives their after(N) transitions.
+
+    sim = CoSimulation()
+    for n in range(1000):
+        sim.add_chart("light%d" % n, "light.svg")
+    sim.send("light0", "go")
+    sim.run(until=60)
+"""
+import io
+import heapq
+import itertools
+import contextlib
+import collections
+
+import scsvg
+
+
+# Queued in place of an event to step a chart when its next timer runs out.
+_TIMER = object()
+
+
+class CoSimContext():
+    """ Context object of one chart in a CoSimulation. The chart's variables
+    are kept in the 'context' dictionary, event is the event being delivered
+    (None for the steps taken without one)."""
+    def __init__(self, name, variables, code):
+        self.name = name
+        self.context = variables
+        self.event = None
+        self.code = code
+
+    def _compile(self, text, mode):
+        code = self.code.get((text, mode))
+        if code is None:
+            code = compile(text.strip().replace("\n", " "), "<%s>" % self.name, mode)
+            self.code[(text, mode)] = code
+        return code
+
+    def eval(self, trigger=None, guard=None):
+        if trigger and (trigger != self.event):
+            return False
+        if guard:
+            return bool(eval(self._compile(guard, "eval"), self.context))
+        return True
+
+    def snapshot(self):
+        return dict(self.context)
+
+    def restore(self, variables):
+        self.context = dict(variables)
+
+    def run_action(self, action):
+        exec(self._compile(action, "exec"), self.context)
+
+
+class CoSimulation():
+    """ A set of named charts exchanging events through a priority queue."""
+    def __init__(self):
+        self.clock = scsvg.VirtualClock()
+        self.queue = []
+        self.sequence = itertools.count()
+        self.charts = collections.OrderedDict()
+        self.models = {}
+        # Compiled guards and actions, shared by all the charts.
+        self.code = {}
+        self.timer_deadlines = {}
+        self.listeners = []
+        self.step_count = 0
+
+    def load_model(self, svg_filename):
+        """ Return the model of the diagram, each file is only loaded once and
+        shared with everyone else loading it (see scsvg.load_model)."""
+        model = self.models.get(svg_filename)
+        if model is None:
+            # The parser reports every shape it finds.
+            with contextlib.redirect_stdout(io.StringIO()):
+                model = scsvg.load_model(svg_filename)
+            self.models[svg_filename] = model
+        return model
+
+    def add_chart(self, name, model, variables=None):
+        """ Add a chart running the model (a StateChartModel or the file name
+        of the diagram) with the given initial variables. The chart takes its
+        initial transitions at the current time. Return its StateChartInstance."""
+        if name in self.charts:
+            raise scsvg.StateChartError("Chart [%s] already exists." % name)
+        if not isinstance(model, scsvg.StateChartModel):
+            model = self.load_model(model)
+        variables = dict(variables or {})
+        variables["name"] = name
+        variables["send"] = self.send
+        chart = scsvg.StateChartInstance(model, CoSimContext(name, variables, self.code))
+        chart.set_clock(self.clock)
+        self.charts[name] = chart
+        self._push(self.clock.now(), 0, name, None)
+        return chart
+
+    def _push(self, t, priority, name, event):
+        heapq.heappush(self.queue, (t, priority, next(self.sequence), name, event))
+
+    def send(self, target, event, delay=0.0, priority=0):
+        """ Queue the event for the chart named target, delay seconds from
+        now. Of the events due at the same time, the ones with the lower
+        priority are delivered first, then in the order they were sent."""
+        if target not in self.charts:
+            raise scsvg.StateChartError("No chart named [%s]." % target)
+        self._push(self.clock.now() + delay, priority, target, event)
+
+    def add_listener(self, listener):
+        """ Call listener(time, name, event, transitions) after every step with
+        the transitions the chart took."""
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def step_chart(self, name, event=None):
+        """ Deliver the event to the chart: advance it one step and run the
+        actions of the transitions it took."""
+        chart = self.charts[name]
+        context = chart.context_object
+        context.event = event
+        try:
+            chart.advance_state()
+            for t in chart.highlighted_transitions:
+                if t.action:
+                    context.run_action(t.action)
+        except Exception as e:
+            raise scsvg.StateChartError("Chart [%s] failed on event [%s]: %s" %
+                                        (name, event, e)) from e
+        finally:
+            context.event = None
+        self.step_count += 1
+
+        # Wake the chart up again when its next timer runs out.
+        deadline = chart.next_deadline()
+        if deadline is None:
+            self.timer_deadlines.pop(name, None)
+        elif self.timer_deadlines.get(name) != deadline:
+            self.timer_deadlines[name] = deadline
+            self._push(deadline, 0, name, _TIMER)
+
+        for listener in self.listeners:
+            listener(self.clock.now(), name, event, chart.highlighted_transitions)
+
+    def run(self, until=None, max_steps=None):
+        """ Deliver the queued events in order until there are none left, the
+        next one is due after the time until or max_steps steps were taken.
+        Return the number of steps taken."""
+        n_steps = 0
+        while self.queue and ((max_steps is None) or (n_steps < max_steps)):
+            t, priority, _, name, event = self.queue[0]
+            if (until is not None) and (t > until):
+                break
+            heapq.heappop(self.queue)
+            if event is _TIMER:
+                # Superseded by a timer restarted or stopped since.
+                if self.timer_deadlines.get(name) != t:
+                    continue
+                del self.timer_deadlines[name]
+                event = None
+            self.clock.set_time(max(t, self.clock.now()))
+            self.step_chart(name, event)
+            n_steps += 1
+        if until is not None:
+            self.clock.set_time(max(until, self.clock.now()))
+        return n_steps
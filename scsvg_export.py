@@ -0,0 +1,102 @@
+#-------------------------------------------------------------------------------
+# Copyright (C) 07/2020 Eyob Demissie
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in 
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A 
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THETHE AUTHORS OR 
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER 
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# 
+# Except as contained in this notice, the name(s) of the above copyright holders 
+# shall not be used in advertising or otherwise to promote the sale, use or other
+# dealings in this Software without prior written authorization.
+#-------------------------------------------------------------------------------
+"""
+Export a simulation trace of a state chart without screenshots, either as a
+single animated SVG (SMIL <set> elements on the stroke color) or as a
+numbered sequence of SVG frames.
+
+A trace is any iterable of (states, transitions) highlighted per step, e.g.
+
+    template = sc.get_svg_template()
+    export_animated_svg(template, trace_steps(sc, 10000), "run.svg")
+
+Both exporters write step by step from the chart's SvgTemplate, so the memory
+used does not grow with the length of the trace.
+"""
+import os
+
+
+def trace_steps(chart, n_steps):
+    """ Advance the chart n_steps times and yield the highlighted states and
+    transitions of every step, starting with the current states."""
+    yield (chart.current_states, [])
+    for n in range(n_steps):
+        chart.advance_state()
+        yield (chart.highlighted_states, chart.highlighted_transitions)
+
+
+def _split_document(template):
+    """ Return the template with nothing highlighted split into the part
+    before the closing </svg> tag and the rest."""
+    xml = template.render([])
+    end = xml.rindex("</svg")
+    head, tail = xml[:end], xml[end:]
+    if "xmlns:xlink" not in head[:head.index(">", head.index("<svg"))]:
+        head = head.replace("<svg", '<svg xmlns:xlink="http://www.w3.org/1999/xlink"', 1)
+    return head, tail
+
+
+def export_animated_svg(template, steps, filename, step_sec=1.0,
+                        color="red", default_color="black"):
+    """ Write one SVG file animating the given steps, each step shown for
+    step_sec seconds. Only the highlight changes between consecutive steps
+    are written. Return the number of steps written."""
+    head, tail = _split_document(template)
+    set_fmt = ('<set xlink:href="#%s" attributeName="stroke" to="%s" '
+               'begin="%gs" fill="freeze"/>\n')
+    lit = set()
+    n = 0
+    with open(filename, "w", encoding="utf-8") as ofile:
+        ofile.write(head)
+        for n, (states, transitions) in enumerate(steps):
+            step_lit = set(template.element_numbers[e]
+                           for e in list(states) + list(transitions)
+                           if e in template.element_numbers)
+            begin = n*step_sec
+            for e in sorted(step_lit - lit):
+                for svg_id in template.element_ids[e]:
+                    ofile.write(set_fmt % (svg_id, color, begin))
+            for e in sorted(lit - step_lit):
+                for svg_id in template.element_ids[e]:
+                    ofile.write(set_fmt % (svg_id, default_color, begin))
+            lit = step_lit
+            n += 1
+        ofile.write(tail)
+    return n
+
+
+def export_frames(template, steps, directory, filename_fmt="frame_%05d.svg",
+                  color="red", default_color="black"):
+    """ Write every step as its own SVG file into the directory, named with
+    filename_fmt % step. Return the number of frames written."""
+    os.makedirs(directory, exist_ok=True)
+    n = 0
+    for n, (states, transitions) in enumerate(steps):
+        filename = os.path.join(directory, filename_fmt % n)
+        with open(filename, "w", encoding="utf-8") as ofile:
+            ofile.writelines(template.iter_render(list(states) + list(transitions),
+                                                  color, default_color))
+        n += 1
+    return n
@@ -0,0 +1,177 @@
+#-------------------------------------------------------------------------------
+# Copyright (C) 07/2020 Eyob Demissie
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THETHE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# Except as contained in this notice, the name(s) of the above copyright holders
+# shall not be used in advertising or otherwise to promote the sale, use or other
+# dealings in this Software without prior written authorization.
+#-------------------------------------------------------------------------------
+"""
+Validate a batch of state chart SVG files (exported from UmLet) without Qt.
+
+Every file is checked in one pass and all of its problems are reported, e.g.
+
+    python scsvg_lint.py examples/ diagrams/other.svg -j 8
+"""
+import sys
+import os
+import io
+import argparse
+import collections
+import contextlib
+import concurrent.futures
+
+import pysvg.parser
+
+import scsvg
+
+
+Problem = collections.namedtuple("Problem", ["filename", "kind", "message"])
+
+
+def find_overlapping_states(states):
+    """ Given a list of states, return the pairs of box states that overlap
+    without one being nested inside the other. Uses a sweep over the x axis so
+    only boxes sharing an x range are compared."""
+    boxes = [s for s in states
+             if isinstance(s.shape, scsvg.DiagramBox) and s.name != scsvg.State.BRANCH_NAME]
+    boxes.sort(key=lambda s: s.shape.p_ul.x)
+    overlapping = []
+    active = []
+    for s in boxes:
+        active = [a for a in active if a.shape.p_br.x > s.shape.p_ul.x]
+        for a in active:
+            if a.shape.overlaps(s.shape):
+                overlapping.append((a, s))
+        active.append(s)
+    return overlapping
+
+
+def lint_diagram(svg):
+    """ Given a parsed SVG diagram, return a list of (kind, message) tuples for
+    every problem that would stop or confuse the simulation."""
+    problems = []
+    errors = []
+    states = scsvg.find_all_states(svg, [], [], errors)
+    problems += [("shape", e) for e in errors]
+
+    errors = []
+    transitions = scsvg.find_all_transitions(svg, [], [], errors)
+    problems += [("shape", e) for e in errors]
+
+    for t in transitions:
+        try:
+            t.select_end_states(states)
+        except scsvg.StateChartError as e:
+            problems.append(("dangling", str(e)))
+            continue
+        t.pt1_state.add_out_transitions(t)
+
+    top_init_states = []
+    for s in states:
+        s.select_sub_states(states)
+        s.select_parent_states(states)
+        if not s.parent_states and s.name == scsvg.State.INIT_NAME:
+            top_init_states.append(s)
+
+    if states and not top_init_states:
+        problems.append(("init", "Diagram has no top level init state."))
+    for s in states:
+        if s.sub_states and not s.init_states:
+            problems.append(("init", "Composite state [%s] has no init state." % s))
+        if s.name == scsvg.State.INIT_NAME and not s.out_transitions:
+            problems.append(("init", "Init state [%s] has no out transition." % s))
+        if s.name == scsvg.State.BRANCH_NAME and not s.out_transitions:
+            problems.append(("branch", "Branch state [%s] has no out transition." % s))
+
+    for s1, s2 in find_overlapping_states(states):
+        problems.append(("overlap", "States [%s] and [%s] overlap." % (s1, s2)))
+
+    return problems
+
+
+def lint_file(svg_filename):
+    """ Lint a single SVG file, return the list of problems found. Runs in a
+    worker process so everything returned must be picklable."""
+    # The parser reports every shape it finds, keep the workers quiet.
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            svg = pysvg.parser.parse(svg_filename)
+            problems = lint_diagram(svg)
+        except Exception as e:
+            problems = [("error", "%s: %s" % (type(e).__name__, e))]
+    return [Problem(svg_filename, kind, message) for kind, message in problems]
+
+
+def find_svg_files(paths):
+    """ Expand the given files and directories into a sorted list of SVG files."""
+    svg_filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                for f in files:
+                    if f.lower().endswith(".svg"):
+                        svg_filenames.append(os.path.join(root, f))
+        else:
+            svg_filenames.append(path)
+    return sorted(svg_filenames)
+
+
+def lint_files(svg_filenames, jobs=None):
+    """ Lint the given files concurrently with a process pool. Return an
+    ordered dictionary of filename to its list of problems."""
+    results = collections.OrderedDict((f, []) for f in svg_filenames)
+    if not svg_filenames:
+        return results
+    chunksize = max(1, len(svg_filenames) // ((jobs or os.cpu_count() or 1) * 4))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        for problems in executor.map(lint_file, svg_filenames, chunksize=chunksize):
+            for p in problems:
+                results[p.filename].append(p)
+    return results
+
+
+def report(results, ofile=sys.stdout):
+    """ Write a consolidated report, return the total number of problems."""
+    n_problems = 0
+    n_bad_files = 0
+    for svg_filename, problems in results.items():
+        if problems:
+            n_bad_files += 1
+        for p in problems:
+            n_problems += 1
+            ofile.write("%s: [%s] %s\n" % (p.filename, p.kind, p.message))
+    ofile.write("%d problem(s) in %d of %d file(s).\n" %
+                (n_problems, n_bad_files, len(results)))
+    return n_problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("paths", nargs="+", help="SVG files or directories to lint")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of worker processes (default: one per CPU)")
+    args = parser.parse_args(argv)
+
+    results = lint_files(find_svg_files(args.paths), args.jobs)
+    return 1 if report(results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,195 @@
+#-------------------------------------------------------------------------------
+# Copyright (C) 07/2020 Eyob Demissie
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in 
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A 
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THETHE AUTHORS OR 
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER 
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# 
+# Except as contained in this notice, the name(s) of the above copyright holders 
+# shall not be used in advertising or otherwise to promote the sale, use or other
+# dealings in this Software without prior written authorization.
+#-------------------------------------------------------------------------------
+"""
+Replay captured controller signal logs through a state chart.
+
+Two log formats are read without loading them into memory:
+
+- a binary log of fixed size records, memory-mapped. The file starts with
+  MAGIC, a little endian uint32 header length and a JSON header
+  {"fields": [names...], "types": "<struct codes>"}; every record is a
+  float64 timestamp followed by one value per field (see write_binary_log).
+- a CSV file with a header line, the timestamp in the first column and one
+  column per context variable, streamed line by line.
+
+    python scsvg_replay.py chart.svg signals.log
+"""
+import sys
+import os
+import ast
+import csv
+import json
+import mmap
+import struct
+import collections
+
+MAGIC = b"SCSVGLOG"
+HEADER = struct.Struct("<8sI")
+
+
+class ReplayContext():
+    """ Context object evaluating triggers and guards against the variables of
+    the log. The expressions are compiled once and cached."""
+    def __init__(self, fields=()):
+        self.context = collections.OrderedDict([("__builtins__", {})])
+        for f in fields:
+            self.context[f] = None
+        self.code = {}
+
+    def _eval(self, expression):
+        code = self.code.get(expression)
+        if code is None:
+            code = compile(expression.strip().replace("\n", " "), "<transition>", "eval")
+            self.code[expression] = code
+        return eval(code, self.context)
+
+    def snapshot(self):
+        return dict(self.context)
+
+    def restore(self, variables):
+        self.context = collections.OrderedDict(variables)
+
+    def eval(self, trigger=None, guard=None):
+        # An empty trigger or guard holds, otherwise both have to.
+        if trigger.strip() and not self._eval(trigger):
+            return False
+        if guard.strip() and not self._eval(guard):
+            return False
+        return True
+
+
+def write_binary_log(filename, fields, types, records):
+    """ Write records of (timestamp, value1, value2, ...) into a binary log.
+    types has one struct code per field, e.g. "?d" for a bool and a float."""
+    header = json.dumps({"fields": list(fields), "types": types}).encode("utf-8")
+    record = struct.Struct("<d" + types)
+    with open(filename, "wb") as ofile:
+        ofile.write(HEADER.pack(MAGIC, len(header)))
+        ofile.write(header)
+        for r in records:
+            ofile.write(record.pack(*r))
+
+
+def read_binary_log(filename):
+    """ Return the field names and an iterator of (timestamp, values...)
+    records read straight from the memory-mapped file."""
+    ifile = open(filename, "rb")
+    magic, header_len = HEADER.unpack(ifile.read(HEADER.size))
+    if magic != MAGIC:
+        ifile.close()
+        raise ValueError("%s is not a scsvg binary log." % filename)
+    header = json.loads(ifile.read(header_len).decode("utf-8"))
+    record = struct.Struct("<d" + header["types"])
+    start = HEADER.size + header_len
+
+    def records():
+        size = os.fstat(ifile.fileno()).st_size
+        if size <= start:
+            ifile.close()
+            return
+        with ifile, mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                end = start + (size - start)//record.size*record.size
+                for r in record.iter_unpack(view[start:end]):
+                    yield r
+            finally:
+                view.release()
+    return header["fields"], records()
+
+
+def _csv_value(text):
+    text = text.strip()
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+
+def read_csv_log(filename):
+    """ Return the field names and an iterator of (timestamp, values...)
+    records streamed from the CSV file."""
+    ifile = open(filename, newline="")
+    reader = csv.reader(ifile)
+    fields = [f.strip() for f in next(reader)[1:]]
+
+    def records():
+        with ifile:
+            for row in reader:
+                if row:
+                    yield tuple([float(row[0])] + [_csv_value(v) for v in row[1:]])
+    return fields, records()
+
+
+def read_log(filename):
+    """ Open a binary or CSV log depending on its first bytes."""
+    with open(filename, "rb") as ifile:
+        is_binary = ifile.read(len(MAGIC)) == MAGIC
+    return read_binary_log(filename) if is_binary else read_csv_log(filename)
+
+
+def replay(chart, fields, records, context=None):
+    """ For every record update the context with its values and advance the
+    chart one step. Yield (timestamp, transitions) for every step in which
+    transitions fired. The context must keep its variables in a 'context'
+    dictionary like ReplayContext (the default) does."""
+    if context is None:
+        context = ReplayContext(fields)
+    chart.context_object = context
+    fields = list(fields)
+    for r in records:
+        # Looked up every time, restore() replaces the dictionary.
+        variables = context.context
+        for name, value in zip(fields, r[1:]):
+            variables[name] = value
+        chart.advance_state()
+        if chart.highlighted_transitions:
+            yield (r[0], chart.highlighted_transitions)
+
+
+def main(argv=None):
+    import argparse
+    import io
+    import contextlib
+    import scsvg
+
+    parser = argparse.ArgumentParser(description="Replay a signal log through a state chart.")
+    parser.add_argument("svg", help="state chart SVG exported from UMLet")
+    parser.add_argument("log", help="binary (see write_binary_log) or CSV signal log")
+    args = parser.parse_args(argv)
+
+    # No view is needed, a headless instance of the model does the stepping.
+    with contextlib.redirect_stdout(io.StringIO()):
+        chart = scsvg.StateChartInstance(scsvg.StateChartModel(args.svg))
+    fields, records = read_log(args.log)
+    for timestamp, transitions in replay(chart, fields, records):
+        for t in transitions:
+            print("%f: %s -> %s [%s]" % (timestamp, t.pt1_state.full_name(),
+                                         t.pt2_state.full_name(), t.trigger))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
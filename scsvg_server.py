@@ -0,0 +1,244 @@
+#-------------------------------------------------------------------------------
+# Copyright (C) 07/2020 Eyob Demissie
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in 
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A 
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THETHE AUTHORS OR 
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER 
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# 
+# Except as contained in this notice, the name(s) of the above copyright holders 
+# shall not be used in advertising or otherwise to promote the sale, use or other
+# dealings in this Software without prior written authorization.
+#-------------------------------------------------------------------------------
+"""
+Serve a live view of a simulated state chart to any number of browsers.
+
+The diagram is sent once as a static SVG (from the chart's SvgTemplate, so a
+chart in lean mode can be served too), after that every refresh of the state
+chart only pushes the numbers of the states/transitions whose highlight
+changed (Server-Sent Events). Everything is served from localhost, the page
+does not need anything from the internet.
+
+    server = scsvg_server.LiveViewServer(sc1, port=8000)
+    server.start()
+    # then open http://127.0.0.1:8000/ in one or more browsers
+"""
+import json
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+PAGE = b"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>scsvg live view</title></head>
+<body style="margin:0">
+<div id="status" style="font-family:sans-serif;font-size:12px">connecting...</div>
+<div id="diagram"></div>
+<script>
+var lit = {};
+var elementIds = [];
+function paint(numbers, color) {
+    for (var i = 0; i < numbers.length; i++) {
+        var ids = elementIds[numbers[i]];
+        for (var j = 0; j < ids.length; j++) {
+            var e = document.getElementById(ids[j]);
+            if (e) { e.setAttribute("stroke", color); }
+        }
+        if (color == "red") { lit[numbers[i]] = true; } else { delete lit[numbers[i]]; }
+    }
+}
+function apply(d) {
+    paint(d.off, "black");
+    paint(d.on, "red");
+    document.getElementById("status").textContent = "step " + d.step;
+}
+function connect() {
+    Promise.all([fetch("diagram.svg").then(function (r) { return r.text(); }),
+                 fetch("elements.json").then(function (r) { return r.json(); })]).then(function (d) {
+        document.getElementById("diagram").innerHTML = d[0];
+        elementIds = d[1];
+        lit = {};
+        var events = new EventSource("events");
+        events.addEventListener("reset", function (e) {
+            var d = JSON.parse(e.data);
+            d.off = Object.keys(lit).map(Number);
+            apply(d);
+        });
+        events.addEventListener("delta", function (e) { apply(JSON.parse(e.data)); });
+        events.addEventListener("reload", function (e) { events.close(); connect(); });
+    });
+}
+connect();
+</script>
+</body></html>
+"""
+
+
+class LiveViewServer:
+    """ Local HTTP server publishing the highlights of a StateChart.
+
+    It registers itself as a listener of the chart, so it is fed from the
+    thread the chart is refreshed on. The HTTP requests are served from their
+    own threads, which only ever read the prepared documents and the per
+    viewer message queues.
+    """
+    KEEPALIVE_SEC = 15
+    MAX_QUEUED = 1000
+
+    def __init__(self, chart, host="127.0.0.1", port=8000):
+        self.chart = chart
+        self.address = (host, port)
+        self.lock = threading.Lock()
+        self.viewers = []
+        self.step = 0
+        self.lit = set()
+        self.template = None
+        self.svg = b""
+        self.element_ids = b"[]"
+        self.numbers = {}
+        self.httpd = None
+        self.thread = None
+        self._update_svg()
+        self.publish(chart.drawn_states, chart.drawn_transitions)
+
+    def _update_svg(self):
+        template = self.chart.get_svg_template()
+        xml = template.render([])
+        # Drop the XML declaration/DOCTYPE, the page inlines the svg element.
+        xml = xml[xml.index("<svg"):]
+        with self.lock:
+            self.template = template
+            self.svg = xml.encode("utf-8")
+            self.element_ids = json.dumps(template.element_ids).encode("utf-8")
+            self.numbers = template.element_numbers
+            self.lit = set()
+
+    def _reset_message(self):
+        return self._message("reset", {"step": self.step, "on": sorted(self.lit)})
+
+    @staticmethod
+    def _message(event, data):
+        return ("event: %s\ndata: %s\n\n" % (event, json.dumps(data))).encode("utf-8")
+
+    def _send(self, message):
+        """ Queue the already encoded message for every viewer. A viewer that
+        fell too far behind gets its backlog replaced by a reset."""
+        for q in self.viewers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                while not q.empty():
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        break
+                q.put_nowait(self._reset_message())
+
+    def publish(self, states, transitions):
+        """ Listener of the chart: push the highlight changes to all viewers."""
+        if self.chart.get_svg_template() is not self.template:
+            # The diagram was reloaded, the viewers have to fetch it again.
+            self._update_svg()
+            with self.lock:
+                self._send(self._message("reload", {}))
+
+        lit = set(self.numbers[e] for e in list(states) + list(transitions)
+                  if e in self.numbers)
+        with self.lock:
+            on = sorted(lit - self.lit)
+            off = sorted(self.lit - lit)
+            if not (on or off):
+                return
+            self.step += 1
+            self.lit = lit
+            self._send(self._message("delta", {"step": self.step, "on": on, "off": off}))
+
+    def add_viewer(self):
+        q = queue.Queue(self.MAX_QUEUED)
+        with self.lock:
+            q.put_nowait(self._reset_message())
+            self.viewers.append(q)
+        return q
+
+    def remove_viewer(self, q):
+        with self.lock:
+            self.viewers.remove(q)
+
+    def start(self):
+        """ Start serving in a background thread."""
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                if path == "/":
+                    self._reply("text/html; charset=utf-8", PAGE)
+                elif path == "/diagram.svg":
+                    with server.lock:
+                        svg = server.svg
+                    self._reply("image/svg+xml", svg)
+                elif path == "/elements.json":
+                    with server.lock:
+                        element_ids = server.element_ids
+                    self._reply("application/json", element_ids)
+                elif path == "/events":
+                    self._stream()
+                else:
+                    self.send_error(404)
+
+            def _reply(self, content_type, body):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _stream(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                q = server.add_viewer()
+                try:
+                    while True:
+                        try:
+                            message = q.get(timeout=server.KEEPALIVE_SEC)
+                        except queue.Empty:
+                            message = b": keepalive\n\n"
+                        self.wfile.write(message)
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    server.remove_viewer(q)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(self.address, Handler)
+        self.httpd.daemon_threads = True
+        self.address = self.httpd.server_address
+        self.chart.add_listener(self.publish)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        print("Live view on http://%s:%d/" % self.address[:2])
+
+    def stop(self):
+        if self.httpd:
+            self.chart.remove_listener(self.publish)
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
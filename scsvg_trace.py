@@ -0,0 +1,298 @@
+#-------------------------------------------------------------------------------
+# Copyright (C) 07/2020 Eyob Demissie
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in 
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A 
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THETHE AUTHORS OR 
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER 
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# 
+# Except as contained in this notice, the name(s) of the above copyright holders 
+# shall not be used in advertising or otherwise to promote the sale, use or other
+# dealings in this Software without prior written authorization.
+#-------------------------------------------------------------------------------
+"""
+Record state chart runs into an SQLite database for analysis afterwards.
+
+Every step of a run stores its time, the states entered and exited, the
+transitions fired and the context variables that changed. Rows are buffered
+and inserted in batches, one transaction per batch. States and transitions
+are referred to by their position in the model (names need not be unique,
+e.g. init and branch pseudo-states), variables by an integer id, and the
+tables are clustered on their primary keys, so looking up the entries of a
+state or the value of a variable at a step is an index search.
+
+    recorder = TraceRecorder("trace.db")
+    run = recorder.start_run(chart, "campaign 1")
+    for k in range(1000000):
+        run.step()
+    recorder.flush()
+    mean_dwell_times(recorder.connection)
+"""
+import sqlite3
+
+import scsvg
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    svg_filename TEXT);
+CREATE TABLE IF NOT EXISTS states (
+    run_id INTEGER,
+    id INTEGER,
+    full_name TEXT,
+    PRIMARY KEY (run_id, id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS transitions (
+    run_id INTEGER,
+    id INTEGER,
+    source_id INTEGER,
+    target_id INTEGER,
+    label TEXT,
+    PRIMARY KEY (run_id, id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS variables (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE);
+CREATE TABLE IF NOT EXISTS steps (
+    run_id INTEGER,
+    step INTEGER,
+    time REAL,
+    PRIMARY KEY (run_id, step)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS entered (
+    run_id INTEGER,
+    state_id INTEGER,
+    step INTEGER,
+    PRIMARY KEY (run_id, state_id, step)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS exited (
+    run_id INTEGER,
+    state_id INTEGER,
+    step INTEGER,
+    PRIMARY KEY (run_id, state_id, step)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS fired (
+    run_id INTEGER,
+    transition_id INTEGER,
+    step INTEGER,
+    PRIMARY KEY (run_id, transition_id, step)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS context (
+    run_id INTEGER,
+    variable_id INTEGER,
+    step INTEGER,
+    value,
+    PRIMARY KEY (run_id, variable_id, step)) WITHOUT ROWID;
+"""
+
+# Context values of other types are not recorded.
+VALUE_TYPES = (bool, int, float, str, type(None))
+
+
+class TraceRecorder():
+    """ An SQLite database the runs are recorded into. Rows are inserted once
+    batch_size of them are waiting and when the recorder is flushed or
+    closed."""
+    def __init__(self, filename, batch_size=50000):
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.batch_size = batch_size
+        self.rows = dict((table, []) for table in
+                         ("steps", "entered", "exited", "fired", "context"))
+        self.n_rows = 0
+        self.variable_ids = {}
+
+    def _get_id(self, table, columns, values):
+        where = " AND ".join("%s = ?" % c for c in columns)
+        cursor = self.connection.execute("SELECT id FROM %s WHERE %s" % (table, where), values)
+        row = cursor.fetchone()
+        if row:
+            return row[0]
+        cursor = self.connection.execute("INSERT INTO %s (%s) VALUES (%s)" %
+                                         (table, ", ".join(columns), ", ".join("?"*len(columns))),
+                                         values)
+        return cursor.lastrowid
+
+    def get_variable_id(self, name):
+        variable_id = self.variable_ids.get(name)
+        if variable_id is None:
+            variable_id = self._get_id("variables", ("name",), (name,))
+            self.variable_ids[name] = variable_id
+        return variable_id
+
+    def start_run(self, instance, name=""):
+        """ Start recording a StateChartInstance (or StateChart), return its
+        TraceRun. The current configuration is recorded as step 0."""
+        model = instance.model
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO runs (name, svg_filename) VALUES (?, ?)",
+                (name, model.svg_filename))
+            run_id = cursor.lastrowid
+            # A state's id is its position in the model's depth first order,
+            # a transition's its position in all_transitions.
+            self.connection.executemany(
+                "INSERT INTO states VALUES (?, ?, ?)",
+                [(run_id, s.order, s.full_name()) for s in model.ordered_states])
+            transition_ids = dict((t, n) for n, t in enumerate(model.all_transitions))
+            self.connection.executemany(
+                "INSERT INTO transitions VALUES (?, ?, ?, ?, ?)",
+                [(run_id, n, t.pt1_state.order, t.pt2_state.order, t.text.strip())
+                 for t, n in transition_ids.items()])
+        run = TraceRun(self, run_id, instance, transition_ids)
+        run.record()
+        return run
+
+    def add_rows(self, table, rows):
+        self.rows[table] += rows
+        self.n_rows += len(rows)
+        if self.n_rows >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ Insert the waiting rows in one transaction."""
+        with self.connection:
+            for table, rows in self.rows.items():
+                if rows:
+                    self.connection.executemany("INSERT INTO %s VALUES (%s)" %
+                                                (table, ", ".join("?"*len(rows[0]))), rows)
+                    del rows[:]
+        self.n_rows = 0
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+class TraceRun():
+    """ The recording of one StateChartInstance, call record() after every
+    step (or step() to advance the instance and record it)."""
+    def __init__(self, recorder, run_id, instance, transition_ids):
+        self.recorder = recorder
+        self.run_id = run_id
+        self.instance = instance
+        self.transition_ids = transition_ids
+        self.step_count = -1
+        self.active_mask = 0
+        self.values = {}
+        # Init and branch pseudo-states are never entered or exited.
+        self.pseudo_mask = 0
+        for s in instance.model.ordered_states:
+            if s.name in (scsvg.State.INIT_NAME, scsvg.State.BRANCH_NAME):
+                self.pseudo_mask |= s.bit
+
+    def _state_rows(self, mask):
+        rows = []
+        while mask:
+            bit = mask & -mask
+            rows.append((self.run_id, bit.bit_length() - 1, self.step_count))
+            mask ^= bit
+        return rows
+
+    def step(self, time=None):
+        self.instance.advance_state()
+        self.record(time)
+
+    def record(self, time=None):
+        """ Record the step the instance just took at the given time (by
+        default the time of its clock or, without a clock, the step number)."""
+        instance = self.instance
+        self.step_count += 1
+        if time is None:
+            time = self.step_count if instance.clock is None else instance.clock.now()
+        active_mask = instance._active_mask(instance.current_states) & ~self.pseudo_mask
+        entered = active_mask & ~self.active_mask
+        exited = self.active_mask & ~active_mask
+
+        fired = []
+        fired_ids = set()
+        stayed = active_mask & self.active_mask
+        reentered = 0
+        for t in instance.highlighted_transitions:
+            # Entering a state twice in one step takes its init transition twice.
+            transition_id = self.transition_ids[t]
+            if transition_id not in fired_ids:
+                fired_ids.add(transition_id)
+                fired.append((self.run_id, transition_id, self.step_count))
+            # A state active before and after the step was exited and entered
+            # again if the transition crossed its border (e.g. a self
+            # transition), or the border of one of its ancestors.
+            if stayed and self.step_count:
+                reentered |= instance.model.get_transition_region(t.pt1_state, t) & stayed
+        if reentered:
+            m = stayed
+            while m:
+                bit = m & -m
+                if instance.model.ordered_states[bit.bit_length() - 1].ancestors_mask & reentered:
+                    reentered |= bit
+                m ^= bit
+            entered |= reentered
+            exited |= reentered
+        self.active_mask = active_mask
+
+        recorder = self.recorder
+        recorder.add_rows("steps", [(self.run_id, self.step_count, time)])
+        if entered:
+            recorder.add_rows("entered", self._state_rows(entered))
+        if exited:
+            recorder.add_rows("exited", self._state_rows(exited))
+        if fired:
+            recorder.add_rows("fired", fired)
+
+        if hasattr(instance.context_object, "snapshot"):
+            variables = instance.context_object.snapshot()
+            if isinstance(variables, dict):
+                changed = []
+                for name, value in variables.items():
+                    if (isinstance(value, VALUE_TYPES) and not name.startswith("__") and
+                        ((name not in self.values) or (self.values[name] != value))):
+                        self.values[name] = value
+                        changed.append((self.run_id, recorder.get_variable_id(name),
+                                        self.step_count, value))
+                if changed:
+                    recorder.add_rows("context", changed)
+
+
+def entered_while(connection, state, variable, value, run_id=None):
+    """ Return (run_id, step, time) of every time the state (fully qualified
+    name) was entered while the context variable had the given value."""
+    sql = """
+        SELECT n.run_id, n.step, t.time
+        FROM entered n
+        JOIN states s ON s.run_id = n.run_id AND s.id = n.state_id
+        JOIN steps t ON t.run_id = n.run_id AND t.step = n.step
+        WHERE s.full_name = ? AND (n.run_id = ? OR ? IS NULL) AND
+            (SELECT c.value FROM context c
+             WHERE c.run_id = n.run_id AND c.step <= n.step AND
+                 c.variable_id = (SELECT id FROM variables WHERE name = ?)
+             ORDER BY c.step DESC LIMIT 1) = ?
+        ORDER BY n.run_id, n.step"""
+    return connection.execute(sql, (state, run_id, run_id, variable, value)).fetchall()
+
+
+def mean_dwell_times(connection, run_id=None):
+    """ Return {full_name: (count, mean dwell time)} of the states, from their
+    exits and the entries before them."""
+    sql = """
+        SELECT s.full_name, COUNT(*), AVG(tx.time - tn.time)
+        FROM exited x
+        JOIN states s ON s.run_id = x.run_id AND s.id = x.state_id
+        JOIN steps tx ON tx.run_id = x.run_id AND tx.step = x.step
+        JOIN steps tn ON tn.run_id = x.run_id AND tn.step =
+            (SELECT MAX(n.step) FROM entered n
+             WHERE n.run_id = x.run_id AND n.state_id = x.state_id AND n.step < x.step)
+        WHERE (x.run_id = ? OR ? IS NULL)
+        GROUP BY s.full_name
+        ORDER BY s.full_name"""
+    return dict((name, (count, mean)) for name, count, mean in
+                connection.execute(sql, (run_id, run_id)))